@@ -6,20 +6,32 @@ from enum import Enum
 # plex settings
 baseurl = "http://127.0.0.1:32400"
 token = "YOUR_PLEX_TOKEN"
+plex_pool_size = 10  # amount of kept-alive connections to plex, should be at least the amount of parallel workers
+plex_timeout = 30  # seconds until a plex request times out
+plex_snapshot_key_check_hours = 24  # the library snapshot is checked for deleted movies at least this often
 
 # letterboxd settings
 use_api = False
 api_username = "USERNAME"
 api_password = "PASSWORD"
 api_use_2fa_code = False
+api_keep_session = True  # stores the letterboxd sign-in and reuses it until it expires
+letterboxd_requests_per_second = 5  # keeps the requests to letterboxd polite
+letterboxd_max_workers = 4  # amount of parallel letterboxd requests
 
 # general settings
 use_playlist_as_watchlist = True   # creates a playlist by the watchlist on letterboxd
 use_builtin_watchlist = False  # uses the builtin watchlist feature in plex
+builtin_watchlist_remove_missing = False  # removes movies from the builtin watchlist that are not on the letterboxd watchlist anymore
+builtin_watchlist_batch_size = 10  # amount of builtin watchlist changes sent to plex in parallel
 sort_by_title = True  # sorts the playlist by name - for watchlist as playlist only
+playlist_reconcile = True  # only add/remove/move the changed items instead of recreating the playlist - for watchlist as playlist only
 ignore_words = ["the", "a", "ein", "eine", "die", "das", "der", "le", "les", "il", "lo", "la"]   # if movie starts with one of those words, ignore them and sort by the second word - for playlist only
 ignore_movies_in_existing_watchlist = True  # for playlist only
 include_watched_not_rated = True  # include movies that have been flagged as watched but are not rated on letterboxd
+rating_diff_sync = False  # compare against the ratings currently stored in plex and only write the changed ones
+rating_write_workers = 4  # amount of ratings written to plex in parallel
+rating_write_retries = 3  # retries per rating if plex is temporarily unavailable
 
 # plex watchlist as playlist settings
 existing_watchlist_name = "Watchlist"  # the name of the playlist used as watchlist
@@ -30,7 +42,10 @@ tmdb_use_api = False
 tmdb_cache = True
 tmdb_invalidate_cache = False
 tmdb_invalidate_cache_days = 30
+tmdb_negative_cache_days = 14  # searches without a result are not repeated for this amount of days
 tmdb_api_key = "YOUR_TMDB_TOKEN"
+tmdb_requests_per_second = 40  # stays below the rate limit of the tmdb api
+tmdb_max_workers = 8  # amount of parallel tmdb lookups
 tmdb_language_code = "US"  # Look up Alpha-2 codes: https://en.wikipedia.org/wiki/ISO_3166-1#Codes
 tmdb_release_country_code = "US"
 tmdb_release_type: tmdb.ReleaseType = tmdb.ReleaseType.DIGITAL
@@ -46,6 +61,9 @@ missing_path = "data/missing.json"
 ignore_path = "data/ignore.json"
 mapping_path = "data/mapping.json"
 autoselection_path = "data/autoselection.json"
+owned_state_path = "data/owned.json"
+letterboxd_session_path = "data/letterboxd_session.json"
+letterboxd_strategy_path = "data/letterboxd_strategies.json"
 db_path = "data/ltp.db"
 
 web_mode = False
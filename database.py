@@ -0,0 +1,84 @@
+import sqlite3
+import threading
+
+from contextlib import contextmanager
+
+import config
+
+BUSY_TIMEOUT_MS = 30000
+STATEMENT_CACHE_SIZE = 256
+
+_local = threading.local()
+
+
+def connection():
+    """
+    Returns the connection of the current thread, opened on first use and reused afterwards.
+    WAL lets readers work while another thread writes, the busy timeout makes writers wait instead of failing.
+    """
+    path = config.db_path
+    conn = getattr(_local, 'connection', None)
+    if conn is not None and _local.path == path:
+        return conn
+
+    if conn is not None:  # db_path was changed in the config
+        conn.close()
+
+    # isolation_level None: statements outside of transaction() commit on their own
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None,
+                           cached_statements=STATEMENT_CACHE_SIZE)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+    conn.execute('PRAGMA synchronous=NORMAL')
+
+    _local.connection = conn
+    _local.path = path
+    _local.depth = 0
+    return conn
+
+
+@contextmanager
+def transaction():
+    """
+    Runs the block in one transaction and yields a cursor. The write lock is taken up front,
+    so two writers never deadlock on upgrading a read. Nested scopes join the outer transaction.
+    """
+    conn = connection()
+    cursor = conn.cursor()
+
+    if _local.depth > 0:
+        _local.depth += 1
+        try:
+            yield cursor
+        finally:
+            _local.depth -= 1
+            cursor.close()
+        return
+
+    conn.execute('BEGIN IMMEDIATE')
+    _local.depth = 1
+    try:
+        yield cursor
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        _local.depth = 0
+        cursor.close()
+
+
+def fetch_one(query, params=()):
+    cursor = connection().execute(query, params)
+    try:
+        return cursor.fetchone()
+    finally:
+        cursor.close()
+
+
+def fetch_all(query, params=()):
+    cursor = connection().execute(query, params)
+    try:
+        return cursor.fetchall()
+    finally:
+        cursor.close()
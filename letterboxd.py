@@ -1,67 +1,190 @@
+import re
+import threading
 import requests
-import sqlite3
 import config
+import database
+import util
 
-from letterboxdpy.movie import Movie
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+REQUEST_TIMEOUT_SECONDS = 30
+CACHE_QUERY_CHUNK_SIZE = 500
+PAGE_CHUNK_SIZE = 16384
+FILM_URL = 'https://letterboxd.com/film/{slug}/'
+USER_AGENT = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+              '(KHTML, like Gecko) Chrome/124.0 Safari/537.36')
+
+TMDB_ID_PATTERNS = [
+    re.compile(r'data-tmdb-id="(\d+)"\s+data-tmdb-type="movie"'),
+    re.compile(r'themoviedb\.org/movie/(\d+)\D'),
+]
+IMDB_ID_PATTERN = re.compile(r'imdb\.com/title/(tt\d+)\D')
+NO_MOVIE_ID = '-1'
+
+_client_lock = threading.Lock()
+_session = None
+_limiter = None
+
+
+def __client():
+    global _session, _limiter
+
+    with _client_lock:
+        rate = max(1, int(config.letterboxd_requests_per_second))
+        if _limiter is None or _limiter.rate != rate:
+            _limiter = util.RateLimiter(rate)
+
+        if _session is None:
+            pool_size = max(1, int(config.letterboxd_max_workers))
+            _session = requests.Session()
+            _session.headers['User-Agent'] = USER_AGENT
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+
+        return _session, _limiter
+
+
+def extract_ids(chunks):
+    """
+    Scans the chunks of a film page for the TMDB and IMDb ids and stops reading as soon as both are found.
+    Returns: (tmdb_id, imdb_id), None for an id that is not on the page
+    """
+    tmdb_id = None
+    imdb_id = None
+    tail = ''
+
+    for chunk in chunks:
+        text = tail + chunk
+
+        if tmdb_id is None:
+            match = next((m for m in (pattern.search(text) for pattern in TMDB_ID_PATTERNS) if m), None)
+            tmdb_id = match.group(1) if match else None
+        if imdb_id is None:
+            match = IMDB_ID_PATTERN.search(text)
+            imdb_id = match.group(1) if match else None
+
+        if tmdb_id is not None and imdb_id is not None:
+            break
+
+        # keep enough to find an id split across two chunks
+        tail = text[-200:]
+
+    return tmdb_id, imdb_id
+
+
+def fetch_ids(slug):
+    """Reads the TMDB and IMDb id from the film page of a slug, see extract_ids."""
+    session, limiter = __client()
+    limiter.acquire()
+
+    with session.get(FILM_URL.format(slug=slug), stream=True, timeout=REQUEST_TIMEOUT_SECONDS) as response:
+        response.raise_for_status()
+        chunks = (chunk.decode('utf-8', 'ignore') for chunk in response.iter_content(PAGE_CHUNK_SIZE))
+        return extract_ids(chunks)
+
+
+def ids_from_slugs(slugs):
+    """
+    Looks up the TMDB and IMDb ids of slugs: film pages of uncached slugs are read concurrently,
+    the found ids are stored in one transaction.
+
+    Returns: dict of slug -> [tmdb_id, imdb_id], tmdb_id being '-1' for pages without a movie id
+    (e.g. TV shows) and [-1, -1] if the page could not be read
+    """
+    slugs = list(dict.fromkeys(slug for slug in slugs if slug))
+    ids = {}
+
+    for start in range(0, len(slugs), CACHE_QUERY_CHUNK_SIZE):
+        chunk = slugs[start:start + CACHE_QUERY_CHUNK_SIZE]
+        placeholders = ', '.join('?' for _ in chunk)
+        rows = database.fetch_all(f'SELECT slug, tmdb_id, imdb_id FROM letterboxd_cache '
+                                  f'WHERE slug IN ({placeholders}) AND tmdb_id IS NOT NULL', chunk)
+        ids.update({slug: [tmdb_id, imdb_id] for slug, tmdb_id, imdb_id in rows})
+
+    to_fetch = [slug for slug in slugs if slug not in ids]
 
+    def fetch(slug):
+        try:
+            return fetch_ids(slug)
+        except Exception:
+            return None  # not cached, the page is read again next time
 
-def __letterboxd_movie_from_slug(slug):
-    movie = Movie(slug)
-    return movie
+    if to_fetch:
+        with ThreadPoolExecutor(max_workers=max(1, int(config.letterboxd_max_workers))) as executor:
+            results = list(executor.map(fetch, to_fetch))
 
+        rows = []
+        for slug, result in zip(to_fetch, results):
+            if result is None:
+                ids[slug] = [-1, -1]
+                continue
 
-def ids_from_slug(slug):
-    connection = sqlite3.connect(config.db_path)
-    cursor = connection.cursor()
+            tmdb_id, imdb_id = result
+            # a page without a movie id stays that way, the sentinel keeps it from being downloaded every run
+            ids[slug] = [tmdb_id or NO_MOVIE_ID, imdb_id]
+            rows.append((tmdb_id or NO_MOVIE_ID, imdb_id, slug))
 
-    select_query = 'SELECT * FROM letterboxd_cache WHERE slug = ?'
-    cursor.execute(select_query, (slug,))
-    rs = cursor.fetchone()
+        with database.transaction() as cursor:
+            cursor.executemany('UPDATE letterboxd_cache SET tmdb_id = ?, imdb_id = ? WHERE slug = ?', rows)
 
-    if rs and rs[4] is not None:
-        return [rs[4], rs[5]]
-    else:
-        try:
-            lb_movie = __letterboxd_movie_from_slug(slug)
-            tmdb_url = lb_movie.tmdb_link
-            parts = tmdb_url.split("/")
-            tmdb_id = parts[len(parts) - 2]
-
-            imdb_url = lb_movie.imdb_link
-            if imdb_url is not None:
-                parts = imdb_url.split("/")
-                imdb_id = parts[len(parts) - 2]
-            else:
-                imdb_id = None
-
-            set_tmdb_id(slug, tmdb_id, imdb_id)
-            return [tmdb_id, imdb_id]
-        except Exception:
-            return [-1, -1]
+    return ids
 
 
-def slug_from_short_url(uri):
-    connection = sqlite3.connect(config.db_path)
-    cursor = connection.cursor()
+def __get_redirected_url(url) -> str:
+    session, limiter = __client()
+    limiter.acquire()
+    response = session.head(url, allow_redirects=True, timeout=REQUEST_TIMEOUT_SECONDS)
+    return response.url
 
-    select_query = 'SELECT * FROM letterboxd_cache WHERE short_url = ?'
-    cursor.execute(select_query, (uri,))
-    rs = cursor.fetchone()
 
-    if not rs:
-        long_url = __get_redirected_url(uri)
-        parts = long_url.split('/')
-        slug = parts[len(parts) - 2]
+def __slug_from_long_url(long_url: str) -> str:
+    parts = long_url.split('/')
+    return parts[len(parts) - 2]
 
-        store_to_cache(slug, uri, long_url)
-        return slug
-    else:
-        return rs[2]
 
+def slugs_from_short_urls(uris):
+    """
+    Resolves many boxd.it short urls at once. Cached urls are read with one query per chunk, the others
+    are resolved concurrently and stored in one transaction. Urls that could not be resolved are left out.
 
-def __get_redirected_url(url) -> str:
-    response = requests.head(url, allow_redirects=True)
-    return response.url
+    Returns: dict of short url -> slug
+    """
+    uris = list(dict.fromkeys(uri for uri in uris if uri))
+    slugs = {}
+
+    for start in range(0, len(uris), CACHE_QUERY_CHUNK_SIZE):
+        chunk = uris[start:start + CACHE_QUERY_CHUNK_SIZE]
+        placeholders = ', '.join('?' for _ in chunk)
+        slugs.update(database.fetch_all(f'SELECT short_url, slug FROM letterboxd_cache '
+                                        f'WHERE short_url IN ({placeholders})', chunk))
+
+    to_resolve = [uri for uri in uris if uri not in slugs]
+
+    def resolve(uri):
+        try:
+            return __get_redirected_url(uri)
+        except requests.RequestException:
+            return None
+
+    if to_resolve:
+        with ThreadPoolExecutor(max_workers=max(1, int(config.letterboxd_max_workers))) as executor:
+            long_urls = list(executor.map(resolve, to_resolve))
+
+        rows = []
+        for uri, long_url in zip(to_resolve, long_urls):
+            if long_url is None:
+                continue
+            slugs[uri] = __slug_from_long_url(long_url)
+            rows.append((uri, slugs[uri], long_url, slugs[uri]))
+
+        # one row per slug, a slug may be reached through several short links
+        with database.transaction() as cursor:
+            cursor.executemany('INSERT INTO letterboxd_cache (short_url, slug, long_url) SELECT ?, ?, ? '
+                               'WHERE NOT EXISTS (SELECT 1 FROM letterboxd_cache WHERE slug = ?)', rows)
+
+    return slugs
 
 
 def create_table():
@@ -77,52 +200,15 @@ def create_table():
     )
     '''
 
-    connection = sqlite3.connect(config.db_path)
-    cursor = connection.cursor()
-    cursor.execute(create_table_query)
-    connection.commit()
-    connection.close()
+    with database.transaction() as cursor:
+        cursor.execute(create_table_query)
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_letterboxd_short_url ON letterboxd_cache (short_url);')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_letterboxd_slug ON letterboxd_cache (slug);')
 
 
 def short_to_long_url(short_url: str) -> str:
-    connection = sqlite3.connect(config.db_path)
-    cursor = connection.cursor()
-
     select_query = 'SELECT * FROM letterboxd_cache WHERE short_url = ?'
-    cursor.execute(select_query, (short_url,))
-    rs = cursor.fetchone()
+    rs = database.fetch_one(select_query, (short_url,))
 
     if rs:
         return rs[3]
-
-
-def store_to_cache(slug: str, short_url: str, long_url: str, tmdb_id: str = None):
-    connection = sqlite3.connect(config.db_path)
-    cursor = connection.cursor()
-
-    select_query = 'SELECT * FROM letterboxd_cache WHERE slug = ?'
-    cursor.execute(select_query, (slug,))
-    rs = cursor.fetchone()
-
-    if not rs:
-        insert_query = 'INSERT INTO letterboxd_cache (short_url, slug, long_url, tmdb_id) VALUES (?, ?, ?, ?)'
-        cursor.execute(insert_query, (short_url, slug, long_url, tmdb_id))
-        connection.commit()
-
-    cursor.close()
-    connection.close()
-
-
-def set_tmdb_id(slug: str, tmdb_id: str, imdb_id: str):
-    try:
-        connection = sqlite3.connect(config.db_path)
-        cursor = connection.cursor()
-
-        update_query = 'UPDATE letterboxd_cache SET tmdb_id = ?, imdb_id = ? WHERE slug = ?'
-        cursor.execute(update_query, (tmdb_id, imdb_id, slug))
-        connection.commit()
-
-        cursor.close()
-        connection.close()
-    except sqlite3.Error:
-        pass
@@ -0,0 +1,326 @@
+import json
+import logging
+import time
+
+import config
+import database
+
+FETCH_CHUNK_SIZE = 100
+
+
+def normalize_title(title):
+    if title is None:
+        return ""
+    return " ".join(str(title).lower().split())
+
+
+def loaded_attr(item, attr, default=None):
+    # plexapi reloads partial objects when an attribute is None/empty, which
+    # costs a full metadata request per movie - read the parsed value only.
+    try:
+        value = vars(item).get(attr)
+    except TypeError:
+        value = getattr(item, attr, default)
+    return default if value is None else value
+
+
+def item_guids(item):
+    guids = []
+
+    plex_guid = loaded_attr(item, 'guid')
+    if plex_guid:
+        guids.append(str(plex_guid))
+
+    for guid in loaded_attr(item, 'guids', []):
+        guid_id = getattr(guid, 'id', guid)
+        if guid_id:
+            guids.append(str(guid_id))
+
+    return guids
+
+
+def _timestamp(value):
+    if value is None:
+        return None
+    if hasattr(value, 'timestamp'):
+        return int(value.timestamp())
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class LibraryEntry:
+    """Snapshot row of a Plex movie, exposing the attributes the sync code reads from plexapi items."""
+
+    def __init__(self, rating_key, title, year, edition_title=None, guid=None, guids=None,
+                 user_rating=None, added_at=None, updated_at=None):
+        self.ratingKey = int(rating_key)
+        self.key = f'/library/metadata/{self.ratingKey}'
+        self.title = title
+        self.year = year
+        self.editionTitle = edition_title
+        self.guid = guid
+        self.guids = guids or []
+        self.userRating = user_rating
+        self.addedAt = added_at
+        self.updatedAt = updated_at
+
+    @staticmethod
+    def from_item(item):
+        plex_guid = loaded_attr(item, 'guid')
+        return LibraryEntry(
+            loaded_attr(item, 'ratingKey'),
+            loaded_attr(item, 'title'),
+            loaded_attr(item, 'year'),
+            loaded_attr(item, 'editionTitle'),
+            plex_guid,
+            [guid for guid in item_guids(item) if guid != plex_guid],
+            loaded_attr(item, 'userRating'),
+            _timestamp(loaded_attr(item, 'addedAt')),
+            _timestamp(loaded_attr(item, 'updatedAt')),
+        )
+
+    def __repr__(self):
+        return f'{self.title} ({self.year})'
+
+
+class LibraryIndex:
+    """In-memory lookup of a Plex movie section by GUID and by normalized title + year."""
+
+    def __init__(self, items=None):
+        self._by_guid = {}
+        self._by_title = {}
+        self._count = 0
+
+        for item in items or []:
+            self.add(item)
+
+    def __len__(self):
+        return self._count
+
+    def add(self, item):
+        self._count += 1
+
+        for guid in item_guids(item):
+            self._by_guid.setdefault(guid, []).append(item)
+
+        title_key = normalize_title(loaded_attr(item, 'title'))
+        if title_key:
+            self._by_title.setdefault(title_key, []).append(item)
+
+    def find_guid(self, guid):
+        return list(self._by_guid.get(str(guid), []))
+
+    def find_tmdb(self, tmdb_id):
+        if tmdb_id in (None, '', -1, '-1'):
+            return []
+        return self.find_guid(f'tmdb://{tmdb_id}')
+
+    def find_imdb(self, imdb_id):
+        if imdb_id in (None, '', -1, '-1'):
+            return []
+        return self.find_guid(f'imdb://{imdb_id}')
+
+    def find_title(self, title, years=None):
+        candidates = self._by_title.get(normalize_title(title), [])
+        if not years:
+            return list(candidates)
+
+        wanted = {str(year) for year in years}
+        return [item for item in candidates if str(loaded_attr(item, 'year')) in wanted]
+
+
+def create_table():
+    create_table_query = '''
+    CREATE TABLE IF NOT EXISTS plex_library (
+        section TEXT NOT NULL,
+        rating_key INTEGER NOT NULL,
+        title TEXT NOT NULL,
+        year INTEGER,
+        edition_title TEXT,
+        guid TEXT,
+        guids TEXT NOT NULL DEFAULT '[]',
+        user_rating REAL,
+        added_at INTEGER,
+        updated_at INTEGER,
+        PRIMARY KEY (section, rating_key)
+    )
+    '''
+
+    with database.transaction() as cursor:
+        cursor.execute(create_table_query)
+
+        create_table_query = '''
+        CREATE TABLE IF NOT EXISTS plex_library_state (
+            section TEXT PRIMARY KEY,
+            watermark INTEGER,
+            keys_checked_at INTEGER,
+            synced_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        '''
+        cursor.execute(create_table_query)
+
+        cursor.execute('PRAGMA table_info(plex_library_state)')
+        if 'keys_checked_at' not in {row[1] for row in cursor.fetchall()}:
+            cursor.execute('ALTER TABLE plex_library_state ADD COLUMN keys_checked_at INTEGER')
+
+
+def __get_state(section):
+    rs = database.fetch_one('SELECT watermark, keys_checked_at FROM plex_library_state WHERE section = ?', (section,))
+    return rs if rs else (None, None)
+
+
+def __snapshot_keys(section):
+    return {row[0] for row in database.fetch_all('SELECT rating_key FROM plex_library WHERE section = ?', (section,))}
+
+
+def __fetch_total_size(plex, section):
+    # an empty page still carries the total, movies.totalSize is cached for the lifetime of the section object
+    data = plex.query(f'/library/sections/{section}/all?type=1&X-Plex-Container-Start=0&X-Plex-Container-Size=0')
+    return int(data.attrib.get('totalSize', 0))
+
+
+def __fetch_rating_keys(plex, section):
+    # read the raw listing, building a plexapi object per movie would cost as much as a full refresh
+    key = (f'/library/sections/{section}/all?type=1'
+           '&excludeElements=Media,Genre,Country,Director,Writer,Role,Producer,Collection,Label,Guid')
+    return {int(element.attrib['ratingKey']) for element in plex.query(key) if element.attrib.get('ratingKey')}
+
+
+def __is_key_check_due(keys_checked_at):
+    interval = float(config.plex_snapshot_key_check_hours) * 3600
+    return keys_checked_at is None or time.time() - keys_checked_at >= interval
+
+
+def __store_entries(cursor, section, items):
+    insert_query = ('INSERT OR REPLACE INTO plex_library '
+                    '(section, rating_key, title, year, edition_title, guid, guids, user_rating, added_at, updated_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)')
+
+    watermark = None
+    rows = []
+    for item in items:
+        entry = LibraryEntry.from_item(item)
+        rows.append((section, entry.ratingKey, entry.title or '', entry.year, entry.editionTitle, entry.guid,
+                     json.dumps(entry.guids), entry.userRating, entry.addedAt, entry.updatedAt))
+
+        for value in (entry.addedAt, entry.updatedAt, _timestamp(loaded_attr(item, 'lastRatedAt'))):
+            if value is not None and (watermark is None or value > watermark):
+                watermark = value
+
+    cursor.executemany(insert_query, rows)
+    return watermark
+
+
+def __fetch_by_keys(movies, rating_keys):
+    keys = [str(rating_key) for rating_key in sorted(rating_keys)]
+
+    items = []
+    for start in range(0, len(keys), FETCH_CHUNK_SIZE):
+        chunk = keys[start:start + FETCH_CHUNK_SIZE]
+        items.extend(movies.fetchItems(f'/library/metadata/{",".join(chunk)}?includeGuids=1'))
+    return items
+
+
+def __fetch_changed(movies, watermark):
+    # plexapi only accepts whitelisted filter fields, so query the section endpoint directly.
+    # A new rating bumps lastRatedAt but not updatedAt, hence the second request. The boundary
+    # second is fetched again on purpose, upserting an unchanged row is harmless.
+    changed = {}
+    for field in ('updatedAt', 'lastRatedAt'):
+        key = f'/library/sections/{movies.key}/all?type=1&includeGuids=1&{field}>>={watermark - 1}'
+        for item in movies.fetchItems(key):
+            changed[item.ratingKey] = item
+    return list(changed.values())
+
+
+def refresh_snapshot(plex, movies, logger: logging.Logger, full=False):
+    """Bring the stored snapshot of the section up to date, fetching only items changed since the last run."""
+    section = str(movies.key)
+    started = time.monotonic()
+
+    watermark, keys_checked_at = __get_state(section)
+    removed = set()
+
+    # Plex is read before the transaction starts, so the write lock is only held for the upsert
+    if full or watermark is None:
+        items = movies.search(libtype='movie', includeGuids=True)
+        keys_checked_at = int(time.time())
+    else:
+        items = __fetch_changed(movies, watermark)
+
+        # Deletions leave no timestamp behind. The rating keys are only listed if the size does not add up,
+        # a deletion paired with an addition is caught by the periodic check.
+        stored = __snapshot_keys(section)
+        expected_size = len(stored | {int(item.ratingKey) for item in items})
+        if __is_key_check_due(keys_checked_at) or __fetch_total_size(plex, section) != expected_size:
+            current = __fetch_rating_keys(plex, section)
+            keys_checked_at = int(time.time())
+            removed = stored - current
+
+            # e.g. movies moved in from another section keep their old timestamps
+            missing = current - stored - {int(item.ratingKey) for item in items}
+            if missing:
+                items += __fetch_by_keys(movies, missing)
+
+    with database.transaction() as cursor:
+        if full or watermark is None:
+            cursor.execute('DELETE FROM plex_library WHERE section = ?', (section,))
+        if removed:
+            cursor.executemany('DELETE FROM plex_library WHERE section = ? AND rating_key = ?',
+                               [(section, rating_key) for rating_key in removed])
+
+        new_watermark = __store_entries(cursor, section, items)
+        if new_watermark is None or (watermark is not None and new_watermark < watermark):
+            new_watermark = watermark
+
+        cursor.execute('INSERT OR REPLACE INTO plex_library_state (section, watermark, keys_checked_at, synced_at) '
+                       'VALUES (?, ?, ?, CURRENT_TIMESTAMP)', (section, new_watermark, keys_checked_at))
+
+    logger.info(f'Plex library snapshot refreshed with {len(items)} changed and {len(removed)} removed movies '
+                f'in {time.monotonic() - started:.1f}s')
+
+
+def load_entries(section):
+    rows = database.fetch_all('SELECT rating_key, title, year, edition_title, guid, guids, user_rating, '
+                              'added_at, updated_at FROM plex_library WHERE section = ?', (str(section),))
+
+    return [LibraryEntry(row[0], row[1], row[2], row[3], row[4], json.loads(row[5] or '[]'), row[6], row[7], row[8])
+            for row in rows]
+
+
+def load_index(plex, movies, logger: logging.Logger, full=False):
+    refresh_snapshot(plex, movies, logger, full=full)
+    index = LibraryIndex(load_entries(movies.key))
+    logger.info(f'Indexed {len(index)} Plex movies from snapshot')
+    return index
+
+
+def store_user_ratings(section, ratings):
+    """Record ratings written to Plex in the snapshot, ratings being (ratingKey, rating) pairs."""
+    if not ratings:
+        return
+
+    with database.transaction() as cursor:
+        cursor.executemany('UPDATE plex_library SET user_rating = ? WHERE section = ? AND rating_key = ?',
+                           [(rating, str(section), int(rating_key)) for rating_key, rating in ratings])
+
+
+def fetch_items(plex, entries):
+    """Turn snapshot entries into plexapi items with one request per chunk; plexapi items pass through."""
+    keys = [str(entry.ratingKey) for entry in entries if isinstance(entry, LibraryEntry)]
+
+    fetched = {}
+    for start in range(0, len(keys), FETCH_CHUNK_SIZE):
+        chunk = keys[start:start + FETCH_CHUNK_SIZE]
+        for item in plex.fetchItems(f'/library/metadata/{",".join(chunk)}'):
+            fetched[int(item.ratingKey)] = item
+
+    items = []
+    for entry in entries:
+        if not isinstance(entry, LibraryEntry):
+            items.append(entry)
+        elif entry.ratingKey in fetched:
+            items.append(fetched[entry.ratingKey])
+    return items
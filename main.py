@@ -7,13 +7,15 @@ import threading
 import time
 import inspect
 
-from flask import Flask, jsonify, request, Response, render_template
+from flask import Flask, jsonify, request, Response, render_template, stream_with_context
 from enum import Enum
 
 import csv
 import config
 import letterboxd
+import library
 import owned
+import plexclient
 import rating
 import tmdb
 import watchlist
@@ -22,8 +24,7 @@ import shutil
 import selector
 import util
 
-from session import Session
-from plexapi.myplex import PlexServer
+from session import Session, get_strategy_stats
 
 app = Flask(__name__)
 
@@ -31,9 +32,11 @@ plex = None
 movies = None
 
 TASK_LOG_LIMIT = 200
-THREAD_TASKS = {"watchlist", "rating"}
+THREAD_TASKS = {"watchlist", "rating", "refresh_release_cache"}
+RELEASE_REFRESH_CHUNK_SIZE = 50
 task_states = {}
 task_listeners = {}
+task_cancel_events = {}
 task_state_lock = threading.Lock()
 
 
@@ -109,10 +112,27 @@ def lb_export(task_name=None, progress_callback=None):
     required_files = _required_export_files_for_task(task_name)
 
     try:
+        session_path = config.letterboxd_session_path if config.api_keep_session else None
+
         log_progress(progress_callback, "Signing in to Letterboxd...")
-        session = Session(config.api_username, config.api_password, config.api_use_2fa_code)
+        session = Session(config.api_username, config.api_password, config.api_use_2fa_code, session_path,
+                          config.letterboxd_strategy_path)
+        if session.restored:
+            log_progress(progress_callback, "Reusing stored Letterboxd session")
+
         log_progress(progress_callback, "Downloading latest Letterboxd export...")
-        session.download_export_data(zipfile_name)
+        try:
+            session.download_export_data(zipfile_name)
+        except Exception as exc:
+            if not session.restored:
+                raise
+
+            # the stored session passed the check but was refused for the export, sign in from scratch
+            log_progress(progress_callback, f"Stored Letterboxd session was refused ({exc}), signing in again...")
+            session.clear_session()
+            session = Session(config.api_username, config.api_password, config.api_use_2fa_code, session_path,
+                              config.letterboxd_strategy_path)
+            session.download_export_data(zipfile_name)
         _extract_export_archive(zipfile_name, progress_callback, required_files=required_files)
 
         missing_files = [path for path in required_files if not util.resolve_existing_path(path)]
@@ -139,6 +159,12 @@ def run_owned(logger, amount=200):
     logger.name = 'OWNED'
     return owned.create_csv(movies, amount, logger)
 
+def run_owned_incremental(logger):
+    logger.name = 'OWNED'
+    filename, removed_filename, state = owned.create_incremental_csv(plex, movies, logger)
+    owned.commit_incremental_export(state)  # the files on disk are the delivery
+    return filename, removed_filename
+
 def run_rating(logger, progress_callback=None):
     lb_export("rating", progress_callback)
 
@@ -146,6 +172,75 @@ def run_rating(logger, progress_callback=None):
     rating.rating(plex, movies, logger, progress_callback)
     return "Updated ratings"
 
+def run_refresh_release_cache(logger, progress_callback=None, cancel_event=None):
+    logger.name = 'RELEASES'
+    cancel_event = cancel_event or threading.Event()
+
+    with open(config.missing_path, "r", encoding="utf-8") as f:
+        missing = json.load(f)
+
+    errors = []
+    to_refresh = []
+    for m in missing:
+        lb_name = m.get("name", "")
+        lb_year = m.get("year", "")
+
+        if not lb_name or not lb_year:
+            continue
+
+        movie_id = tmdb.get_tmdb_id_for_letterboxd_movie(lb_name, str(lb_year))
+        if not movie_id:
+            errors.append(f"{lb_name} ({lb_year}): no TMDB id cached")
+            continue
+        to_refresh.append((m, movie_id))
+
+    log_progress(progress_callback, f"Refreshing release dates of {len(to_refresh)} missing entries")
+
+    refreshed = 0
+    changed = 0
+    for start in range(0, len(to_refresh), RELEASE_REFRESH_CHUNK_SIZE):
+        if cancel_event.is_set():
+            break
+
+        # every chunk is looked up concurrently and written with a single commit
+        chunk = to_refresh[start:start + RELEASE_REFRESH_CHUNK_SIZE]
+        failed = {}
+        try:
+            answered = tmdb.refresh_release_dates((movie_id for _, movie_id in chunk), failed)
+        except Exception as e:
+            logger.exception("Release refresh failed")
+            answered = set()
+            failed = {movie_id: str(e) for _, movie_id in chunk}
+
+        for m, movie_id in chunk:
+            if movie_id not in answered:
+                errors.append(f"{m.get('name')} ({m.get('year')}): {failed.get(movie_id, 'no answer from TMDB')}")
+                continue
+
+            best_overall = tmdb.get_stored_configured_release_date(movie_id)
+            refreshed += 1
+
+            previous = m.get("release_date")
+            if best_overall != previous:
+                m["release_date"] = best_overall
+                changed += 1
+
+        log_progress(progress_callback, f"Refreshed {min(start + len(chunk), len(to_refresh))}/{len(to_refresh)} "
+                                        f"entries, {changed} release dates updated")
+
+    with open(config.missing_path, "w", encoding="utf-8") as f:
+        json.dump(missing, f, indent=2)
+
+    for error in errors:
+        log_progress(progress_callback, f"Skipped {error}")
+
+    return (
+        ("Cancelled after refreshing" if cancel_event.is_set() else "Refreshed")
+        + f" TMDB release cache for {refreshed} missing entries; "
+        + f"updated {changed} release dates in missing list"
+        + (f" ({len(errors)} entries skipped)" if errors else "")
+    )
+
 @app.route("/")
 def index():
     missing = load_json(config.missing_path)
@@ -322,6 +417,7 @@ def _run_threaded_task(name):
     task_runners = {
         "watchlist": run_watchlist,
         "rating": run_rating,
+        "refresh_release_cache": run_refresh_release_cache,
     }
 
     if name not in task_runners:
@@ -333,21 +429,32 @@ def _run_threaded_task(name):
     start_message = f"{name.capitalize()} task started"
     _start_task_state(name, start_message)
 
+    runner = task_runners[name]
+    cancel_event = threading.Event()
+    kwargs = {}
+    if "cancel_event" in inspect.signature(runner).parameters:
+        kwargs["cancel_event"] = cancel_event
+        with task_state_lock:
+            task_cancel_events[name] = cancel_event
+
     def run_task():
         logger = logging.getLogger(name.upper())
         logger.setLevel(logging.INFO)
 
         try:
-            result = task_runners[name](logger, lambda msg: _append_task_log(name, msg))
+            result = runner(logger, lambda msg: _append_task_log(name, msg), **kwargs)
             if result:
                 _append_task_log(name, result)
-            _finish_task_state(name, "completed", result or f"{name.capitalize()} task completed")
+            status = "cancelled" if cancel_event.is_set() else "completed"
+            _finish_task_state(name, status, result or f"{name.capitalize()} task {status}")
         except Exception as exc:
             logging.exception("Task %s failed", name)
             error_message = f"{name.capitalize()} task failed: {exc}"
             _append_task_log(name, error_message)
             _finish_task_state(name, "failed", error_message)
         finally:
+            with task_state_lock:
+                task_cancel_events.pop(name, None)
             _close_task_streams(name)
 
     threading.Thread(target=run_task, daemon=True).start()
@@ -359,6 +466,7 @@ def action(name):
     if name not in [
         "watchlist",
         "owned",
+        "owned_incremental",
         "rating",
         "cleanup_missing",
         "strip_missing_years",
@@ -373,13 +481,44 @@ def action(name):
     elif name == "owned":
         logger = logging.getLogger('OWNED')
         logger.setLevel(logging.INFO)
-        csv_data = run_owned(logger)
+        try:
+            csv_stream = owned.stream_csv(movies, 200, logger)
+        except Exception as e:
+            return jsonify({
+                "success": False,
+                "message": str(e),
+            }), 500
+
         return Response(
-            csv_data,
+            stream_with_context(csv_stream),
             mimetype="text/csv",
             headers={"Content-Disposition": "attachment; filename=owned.csv"}
         )
 
+    elif name == "owned_incremental":
+        logger = logging.getLogger('OWNED')
+        logger.setLevel(logging.INFO)
+        logger.name = 'OWNED'
+        try:
+            filename, removed_filename, state = owned.create_incremental_csv(plex, movies, logger)
+            archive = owned.zip_files([filename, removed_filename])
+        except Exception as e:
+            return jsonify({
+                "success": False,
+                "message": str(e),
+            }), 500
+
+        def send_archive():
+            yield archive
+            # only remembered once the whole archive is handed out, an aborted download is exported again
+            owned.commit_incremental_export(state)
+
+        return Response(
+            send_archive(),
+            mimetype="application/zip",
+            headers={"Content-Disposition": "attachment; filename=owned_incremental.zip"}
+        )
+
     elif name == "cleanup_missing":
         with open(config.missing_path, "r", encoding="utf-8") as f:
             missing = json.load(f)
@@ -447,49 +586,6 @@ def action(name):
             message=f"Cleaned years from {changed} missing entries"
         )
 
-    elif name == "refresh_release_cache":
-        with open(config.missing_path, "r", encoding="utf-8") as f:
-            missing = json.load(f)
-
-        refreshed = 0
-        changed = 0
-        unresolved = 0
-
-        for m in missing:
-            lb_name = m.get("name", "")
-            lb_year = m.get("year", "")
-
-            if not lb_name or not lb_year:
-                continue
-
-            try:
-                movie_id = tmdb.get_tmdb_id_for_letterboxd_movie(lb_name, str(lb_year))
-                if not movie_id:
-                    unresolved += 1
-                    continue
-
-                best_overall = tmdb.get_configured_release_date_for_movie(movie_id, refresh=True)
-                refreshed += 1
-
-                previous = m.get("release_date")
-                if best_overall != previous:
-                    m["release_date"] = best_overall
-                    changed += 1
-            except Exception:
-                pass
-
-        with open(config.missing_path, "w", encoding="utf-8") as f:
-            json.dump(missing, f, indent=2)
-
-        return jsonify(
-            success=True,
-            message=(
-                f"Refreshed TMDB release cache for {refreshed} missing entries; "
-                f"updated {changed} release dates in missing list"
-                + (f" ({unresolved} entries without TMDB id skipped)" if unresolved else "")
-            )
-        )
-
 @app.route("/stream/<task_name>")
 def stream_task(task_name):
     if task_name not in THREAD_TASKS:
@@ -535,11 +631,26 @@ def task_status():
     return jsonify(_task_status_payload())
 
 
+@app.route("/task/<task_name>/cancel", methods=["POST"])
+def task_cancel(task_name):
+    if task_name not in THREAD_TASKS:
+        return jsonify(success=False, message=f"Unknown task '{task_name}'"), 404
+
+    with task_state_lock:
+        cancel_event = task_cancel_events.get(task_name)
+
+    if cancel_event is None:
+        return jsonify(success=False, message=f"{task_name.capitalize()} task is not running or cannot be cancelled")
+
+    cancel_event.set()
+    _append_task_log(task_name, "Cancelling after the current batch...")
+    return jsonify(success=True, message=f"{task_name.capitalize()} task cancelling")
+
+
 @app.route("/tmdb/releases/<movie_id>")
 def tmdb_releases(movie_id):
     try:
-        releases = tmdb.get_release_dates(movie_id)
-        releases = tmdb.get_first_release_per_type(releases)
+        releases = tmdb.get_first_releases(movie_id)
         return jsonify({
             "success": True,
             "movie_id": movie_id,
@@ -566,8 +677,7 @@ def tmdb_releases_by_missing():
         }), 400
 
     try:
-        movie_id, releases = tmdb.get_release_dates_for_letterboxd_movie(name, year)
-        releases = tmdb.get_first_release_per_type(releases)
+        movie_id, releases = tmdb.get_first_releases_for_letterboxd_movie(name, year)
         return jsonify({
             "success": True,
             "name": name,
@@ -599,8 +709,7 @@ def tmdb_releases_by_missing_fetch():
         }), 400
 
     try:
-        movie_id, releases = tmdb.get_release_dates_for_letterboxd_movie_with_fetch(name, year)
-        releases = tmdb.get_first_release_per_type(releases)
+        movie_id, releases = tmdb.get_first_releases_for_letterboxd_movie(name, year, fetch=True)
         return jsonify({
             "success": True,
             "name": name,
@@ -615,6 +724,53 @@ def tmdb_releases_by_missing_fetch():
             "message": str(e),
         }), 500
 
+@app.route("/tmdb/negative-cache")
+def tmdb_negative_cache():
+    try:
+        entries = tmdb.get_negative_cache()
+        return jsonify({
+            "success": True,
+            "count": len(entries),
+            "entries": entries,
+        })
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "message": str(e),
+        }), 500
+
+
+@app.route("/tmdb/negative-cache/purge", methods=["POST"])
+def tmdb_negative_cache_purge():
+    data = request.get_json(silent=True) or {}
+
+    try:
+        deleted = tmdb.purge_negative_cache(data.get("title"), data.get("year"), bool(data.get("expired_only")))
+        return jsonify({
+            "success": True,
+            "deleted": deleted,
+        })
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "message": str(e),
+        }), 500
+
+
+@app.route("/letterboxd/strategies")
+def letterboxd_strategies():
+    try:
+        return jsonify({
+            "success": True,
+            **get_strategy_stats(config.letterboxd_strategy_path),
+        })
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "message": str(e),
+        }), 500
+
+
 @app.route("/config", methods=["GET"])
 def config_page():
     # return HTML page
@@ -674,8 +830,9 @@ def config_save():
                 tmdb.reorganize_indexes()
                 tmdb.invalidate_cache()
                 letterboxd.create_table()
+            library.create_table()
 
-            plex = PlexServer(config.baseurl, config.token)
+            plex = plexclient.get_server()
             movies = plex.library.section('Movies')
             connected = True
         except Exception as e:
@@ -795,17 +952,28 @@ def main():
                         help='creates a csv file to import to a Letterboxd list. ' +
                              'Used to get the \'owned\' filter. If number is passed after, only that amount of recent movies ' +
                              'will get processed')
+    parser.add_argument('--owned-incremental', action='store_true',
+                        help='like --owned, but only exports movies added since the last run. ' +
+                             'Movies removed from Plex since then are written to owned_removed.csv')
     parser.add_argument('-w', '--watchlist', action='store_true',
                         help='exports movies from Letterboxd watchlist to Plex')
     parser.add_argument('--web', action='store_true', help='starting web server')
+    parser.add_argument('--import-tmdb-ids', metavar='FILE',
+                        help='imports a TMDB daily id export (movie_ids_MM_DD_YYYY.json.gz) to look up movies offline')
     args = parser.parse_args()
 
     logger = logging.getLogger('')
     logger.setLevel(level=logging.INFO)
 
 
+    if args.import_tmdb_ids:
+        tmdb.create_table()
+        imported = tmdb.import_id_export(args.import_tmdb_ids, logger)
+        print(f"Imported {imported} TMDB ids")
+        return
+
     try:
-        plex = PlexServer(config.baseurl, config.token)
+        plex = plexclient.get_server()
         movies = plex.library.section('Movies')
     except Exception:
         logger.error("Not able to connect to Plex")
@@ -815,6 +983,7 @@ def main():
         tmdb.reorganize_indexes()
         tmdb.invalidate_cache()
         letterboxd.create_table()
+    library.create_table()
 
     if args.web:
         config.web_mode = True
@@ -824,10 +993,12 @@ def main():
         return
 
     if not args.web:
-        if args.watchlist or (args.owned is None and not args.rating):
+        if args.watchlist or (args.owned is None and not args.owned_incremental and not args.rating):
             run_watchlist(logger)
         if args.owned is not None:
             run_owned(logger, args.owned)
+        if args.owned_incremental:
+            run_owned_incremental(logger)
         if args.rating:
             run_rating(logger)
 
@@ -1,45 +1,162 @@
 import csv
+import json
 import logging
 import io
+import os
+import zipfile
 
+import config
+import library
 from tqdm import tqdm
 
+PAGE_SIZE = 500
+CSV_HEADER = ["Title", "imdbID"]
+
+
+def iter_movies(movies, max_results):
+    """Yield the movies of the section page by page, GUIDs included, newest first if max_results is set."""
+    start = 0
+    while max_results <= 0 or start < max_results:
+        size = PAGE_SIZE if max_results <= 0 else min(PAGE_SIZE, max_results - start)
+        kwargs = {} if max_results <= 0 else {'sort': 'addedAt:desc'}
+        page = movies.search(libtype='movie', includeGuids=True,
+                             container_start=start, container_size=size, maxresults=size, **kwargs)
+
+        yield from page
+
+        if len(page) < size:
+            break
+        start += size
 
-def create_csv(movies, max_results, logger: logging.Logger, filename="owned.csv"):
-    to_export = []
 
+def _imdb_id(movie):
+    return next((guid[len("imdb://"):] for guid in library.item_guids(movie) if guid.startswith('imdb://')), None)
+
+
+def iter_rows(movies, max_results, logger: logging.Logger):
     if max_results <= 0:
         logger.info('No max results set.')
-        to_loop = movies.search()
     else:
         logger.info(f'Max results set to {max_results}')
-        to_loop = movies.recentlyAdded(maxresults=max_results)
-
-    with tqdm(total=len(to_loop), unit='Movies') as pbar:
-        for movie in to_loop:
-            pbar.set_description(f'Processing {movie.title} ({movie.year})'.ljust(80, ' '))
-            for guid in movie.guids:
-                if guid.id.startswith('imdb'):
-                    comb = [movie.title, guid.id[len("imdb://"):]]
-                    to_export.append(comb)
-                    logger.info(f'Appended {movie.title}')
-                    break
+
+    for movie in iter_movies(movies, max_results):
+        imdb_id = _imdb_id(movie)
+        if imdb_id:
+            logger.info(f'Appended {movie.title}')
+            yield [movie.title, imdb_id]
+
+
+def stream_csv(movies, max_results, logger: logging.Logger):
+    """
+    Returns a generator of the CSV content chunk by chunk, so it can be sent while the library is still being read.
+    The first page is read right away, so an unreachable Plex server raises here instead of inside the response.
+    """
+    rows = iter_rows(movies, max_results, logger)
+    first_row = next(rows, None)
+
+    def generate():
+        output = io.StringIO()
+        csv_writer = csv.writer(output, delimiter=',')
+
+        csv_writer.writerow(CSV_HEADER)
+        try:
+            if first_row is not None:
+                csv_writer.writerow(first_row)
+            for row in rows:
+                csv_writer.writerow(row)
+                if output.tell() >= 8192:
+                    yield output.getvalue()
+                    output.seek(0)
+                    output.truncate(0)
+        except Exception:
+            # the status code is already sent, raising aborts the chunked response so the download fails
+            logger.exception('Reading the Plex library failed while streaming owned.csv')
+            raise
+
+        yield output.getvalue()
+
+    return generate()
+
+
+def create_csv(movies, max_results, logger: logging.Logger, filename="owned.csv"):
+    with open(filename, mode="w", newline="", encoding="utf-8") as csv_file, tqdm(unit='Movies') as pbar:
+        csv_writer = csv.writer(csv_file, delimiter=',')
+        csv_writer.writerow(CSV_HEADER)
+        for row in iter_rows(movies, max_results, logger):
+            pbar.set_description(f'Processing {row[0]}'.ljust(80, ' '))
+            csv_writer.writerow(row)
             pbar.update(1)
 
-    # Save CSV to disk
+    logger.info(f"CSV saved to {filename}")
+    return filename
+
+
+def _load_state():
+    if not os.path.exists(config.owned_state_path):
+        return {}
+    with open(config.owned_state_path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def _store_state(state):
+    with open(config.owned_state_path, 'w', encoding='utf-8') as file:
+        json.dump(state, file, indent=3)
+
+
+def _write_rows(filename, rows):
     with open(filename, mode="w", newline="", encoding="utf-8") as csv_file:
         csv_writer = csv.writer(csv_file, delimiter=',')
-        csv_writer.writerow(["Title", "imdbID"])
-        for m in to_export:
-            csv_writer.writerow(m)
-    logger.info(f"CSV saved to {filename}")
+        csv_writer.writerow(CSV_HEADER)
+        csv_writer.writerows(rows)
 
-    # Also return CSV content as string for download
-    output = io.StringIO()
-    csv_writer = csv.writer(output, delimiter=',')
-    csv_writer.writerow(["Title", "imdbID"])
-    for m in to_export:
-        csv_writer.writerow(m)
-    output.seek(0)
-    return output.getvalue()
 
+def create_incremental_csv(plex, movies, logger: logging.Logger, filename="owned_added.csv",
+                           removed_filename="owned_removed.csv"):
+    """
+    Export only movies added since the last export, based on the library snapshot.
+    Movies exported before but no longer in Plex are written to removed_filename.
+    The export is not remembered yet, pass the returned state to commit_incremental_export once it is delivered.
+
+    Returns: (filename, removed_filename, state)
+    """
+    state = _load_state()
+    watermark = state.get("added_at")
+    exported = state.get("movies", {})  # imdb id -> title
+
+    library.refresh_snapshot(plex, movies, logger)
+
+    current = {}
+    added = []
+    max_added_at = watermark
+    for entry in library.load_entries(movies.key):
+        imdb_id = _imdb_id(entry)
+        if not imdb_id:
+            continue
+
+        current[imdb_id] = entry.title
+        is_new = watermark is None or (entry.addedAt or 0) > watermark
+        if is_new or imdb_id not in exported:
+            added.append([entry.title, imdb_id])
+        if entry.addedAt and (max_added_at is None or entry.addedAt > max_added_at):
+            max_added_at = entry.addedAt
+
+    removed = [[title, imdb_id] for imdb_id, title in exported.items() if imdb_id not in current]
+
+    _write_rows(filename, added)
+    _write_rows(removed_filename, removed)
+    logger.info(f"CSV saved to {filename} ({len(added)} added), {removed_filename} ({len(removed)} removed)")
+
+    return filename, removed_filename, {"added_at": max_added_at, "movies": current}
+
+
+def commit_incremental_export(state):
+    """Remember a delivered incremental export, the next one only contains what changed after it."""
+    _store_state(state)
+
+
+def zip_files(filenames):
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for filename in filenames:
+            archive.write(filename, os.path.basename(filename))
+    return output.getvalue()
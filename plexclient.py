@@ -0,0 +1,50 @@
+import threading
+
+import requests
+import config
+
+from requests.adapters import HTTPAdapter
+from plexapi.myplex import PlexServer
+
+_lock = threading.Lock()
+_server = None
+_server_key = None
+_session = None
+
+
+def _create_session():
+    pool_size = max(1, int(config.plex_pool_size))
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_server(baseurl=None, token=None):
+    """
+    Returns a PlexServer sharing one keep-alive connection pool. The server is reused
+    for as long as the url, token and pool settings stay the same.
+    """
+    global _server, _server_key, _session
+
+    baseurl = baseurl or config.baseurl
+    token = token or config.token
+    key = (baseurl, token, int(config.plex_pool_size), int(config.plex_timeout))
+
+    with _lock:
+        if _server is not None and _server_key == key:
+            return _server
+
+        # a replaced server keeps its pool until tasks still using it are done
+        _session = _create_session()
+        _server = PlexServer(baseurl, token, session=_session, timeout=int(config.plex_timeout))
+        _server_key = key
+        return _server
+
+
+def get_session():
+    """The pooled session of the current server, for requests plexapi has no public method for."""
+    get_server()
+    return _session
@@ -4,18 +4,24 @@ import config
 import csv
 import logging
 import util
-import sqlite3
+import database
 import tmdb
 import letterboxd
+import library
+import requests
+import time
 from selector import choose_movie
 
-from plexapi.exceptions import NotFound
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from plexapi.exceptions import BadRequest, NotFound
 from mapping import Mapping
 from movie import Movie
 from ignoremovie import IgnoreMovie
 from missingmovie import MissingMovie
 from tqdm import tqdm
 
+RETRY_BASE_SECONDS = 0.5
+
 
 def rating(plex, movies, logger: logging.Logger, progress_callback=None):
     to_ignore = IgnoreMovie.load_json() or []
@@ -24,9 +30,11 @@ def rating(plex, movies, logger: logging.Logger, progress_callback=None):
     mapping = Mapping.load_json() or []
 
     data = _read_ratings_csv_()
-
-    connection = sqlite3.connect(config.db_path)
-    cursor = connection.cursor()
+    # the incremental refresh picks up ratings changed in Plex through lastRatedAt, so the diff sync stays current
+    index = library.load_index(plex, movies, logger)
+    to_rate = []
+    unchanged = 0
+    ignored = 0
 
     create_table_query = '''
     CREATE TABLE IF NOT EXISTS ratings (
@@ -37,14 +45,31 @@ def rating(plex, movies, logger: logging.Logger, progress_callback=None):
     '''
 
     logger.debug('Creating table')
-    cursor.execute(create_table_query)
-    connection.commit()
+    database.connection().execute(create_table_query)
 
     def publish_progress(message: str):
         logger.info(message)
         if progress_callback:
             progress_callback(message)
 
+    tmdb_lookups = {}
+    if config.tmdb_use_api:
+        to_look_up = []
+        for name, year, stars, uri in data:
+            if any(name == existing.name and year == existing.year for existing in to_ignore):
+                continue
+            mapped = util.find_movie_by_letterboxd_title(mapping, Movie(name, year))
+            if mapped:
+                if mapped.year > -1:
+                    year = mapped.year
+                name = mapped.plex_title
+            # same skip as below, rows that are already rated are not looked up at all
+            if not config.rating_diff_sync and _is_already_rated(name, float(stars) * 2):
+                continue
+            to_look_up.append((name, year, uri))
+
+        tmdb_lookups = _look_up_tmdb(to_look_up, publish_progress)
+
     with tqdm(total=len(data), unit='Movies') as pbar:
         for name, year, stars, uri in data:
             pbar.set_description(f'Processing {name} ({year})'.ljust(80, ' '))
@@ -56,6 +81,7 @@ def rating(plex, movies, logger: logging.Logger, progress_callback=None):
 
             if any(combination.name == existing.name and combination.year == existing.year for existing in
                    to_ignore):  # movie is in ignore list, maybe remove due to the second check after mapping
+                ignored += 1
                 pbar.update(1)
                 continue
 
@@ -69,48 +95,27 @@ def rating(plex, movies, logger: logging.Logger, progress_callback=None):
             was_missing_names.append(name)
 
             calculated_rating = float(stars) * 2
+            rated_title = name
 
-            select_query = 'SELECT 1 FROM ratings WHERE title = ? AND rating = ?'
-            cursor.execute(select_query, (name, calculated_rating))
-            rs = cursor.fetchone()
-            if rs:
+            if not config.rating_diff_sync and _is_already_rated(name, calculated_rating):
                 # Keep missing list in sync even when the rating write is skipped.
                 missing = util.remove_from_missing_if_needed(missing, was_missing_names)
                 logger.debug(f'Movie {name} is already rated as {calculated_rating} - SKIP')
+                unchanged += 1
                 pbar.update(1)
                 continue
 
             if config.tmdb_use_api:
-                logger.debug(f'Trying to look it up on tmdb')
-                slug = letterboxd.slug_from_short_url(uri)
-                ids = letterboxd.ids_from_slug(slug)
-                tmdb_id = ids[0]
-                # imdb_id = ids[1]
-                # logger.info(f'Got TMDB id {tmdb_id} and IMDB id {imdb_id}')
+                tmdb_id, tmdb_result = tmdb_lookups[(name, year, uri)]
                 logger.info(f'Got TMDB id {tmdb_id}')
 
-                tmdb_movies = tmdb.search_movie(title=name, year=year)
-                if len(tmdb_movies) == 0:
-                    logger.info('Searched TMDB, was not able to find.')
-                    tmdb_movies = tmdb.search_movie(title=name)
-
                 # seems like a tv show, skip
-                if len(tmdb_movies) == 0:
+                if tmdb_result is None:
                     pbar.update(1)
                     continue
 
-                tmdb_movie = tmdb_movies[0]
-
                 logger.info(f'Searched TMDB {name} ({year})')
-                org_title = name
-                org_year = year
-
-                # I think only tmdb_id is needed at this state. Whatever - this is not the bottleneck.
-                name = tmdb.translation(tmdb_movie)
-                year = tmdb_movie.release_date[:4]
-                # combination = Movie(name, year)
-                # tmdb_id = tmdb_movie.id
-                tmdb.store_movie_to_cache(name, year, org_title, org_year, tmdb_id)
+                name, year = tmdb_result
 
             # if config.tmdb_use_api:
             #     # imdb_id = tmdb.get_imdb_id(tmdb_id)
@@ -150,55 +155,27 @@ def rating(plex, movies, logger: logging.Logger, progress_callback=None):
             #             missing.append(combination)
             if config.tmdb_use_api:
                 try:
-                    # try to search the movie the normal way first. compare guid then to avoid using movies.getGuid
-                    # because this function is really, really slow af
-                    # search(): 8 - 12 movies/s <> getGuid(): 2 - 4 movies/s
-                    tmdb_result = movies.search(title=name)
-                    matches = []
-
-                    if len(tmdb_result) > 0:
-                        for result in tmdb_result:
-                            guids = getattr(result, 'guids', [])
-                            if any(f"tmdb://{tmdb_id}" in str(guid.id) for guid in guids):
-                                matches.append(result)
-
-                        if len(matches) == 1:
-                            movie = matches[0]
-                            logger.info(f'Found {name} ({year}), will use this for rating update')
-                            was_missing_names.append(movie.title)
-                            missing = util.remove_from_missing_if_needed(missing, was_missing_names)
+                    matches = index.find_tmdb(tmdb_id)
 
-                        elif len(matches) > 1:
-                            movie = choose_movie(autoselector, combination, matches, logger,
-                                                 web_mode=config.web_mode)
-                            if movie:
-                                logger.info(f'User selected {movie.title} ({movie.year}) for rating update')
-                                was_missing_names.append(movie.title)
-                                missing = util.remove_from_missing_if_needed(missing, was_missing_names)
-                            else:
-                                logger.info(f'User skipped selection for {name} ({year})')
-                                raise NotFound  # treat as missing if skipped
-
-                        else:
-                            # No matching TMDb GUIDs found, fallback to getGuid
-                            logger.debug(f'No exact GUID match for {name} ({year}), trying TMDb GUID lookup...')
-                            movie = movies.getGuid(f'tmdb://{tmdb_id}')
-                            if movie:
-                                logger.info(f'Found {name} ({year}) via TMDb ID, will use for rating update')
-                                was_missing_names.append(movie.title)
-                                missing = util.remove_from_missing_if_needed(missing, was_missing_names)
-                            else:
-                                raise NotFound
+                    if len(matches) == 1:
+                        movie = matches[0]
+                        logger.info(f'Found {name} ({year}), will use this for rating update')
+                        was_missing_names.append(movie.title)
+                        missing = util.remove_from_missing_if_needed(missing, was_missing_names)
 
-                    else:
-                        # No Plex results at all, fallback to getGuid
-                        movie = movies.getGuid(f'tmdb://{tmdb_id}')
+                    elif len(matches) > 1:
+                        movie = choose_movie(autoselector, combination, matches, logger,
+                                             web_mode=config.web_mode)
                         if movie:
-                            logger.info(f'Found {name} ({year}) via TMDb ID, will use for rating update')
+                            logger.info(f'User selected {movie.title} ({movie.year}) for rating update')
                             was_missing_names.append(movie.title)
                             missing = util.remove_from_missing_if_needed(missing, was_missing_names)
                         else:
-                            raise NotFound
+                            logger.info(f'User skipped selection for {name} ({year})')
+                            raise NotFound  # treat as missing if skipped
+
+                    else:
+                        raise NotFound
 
                 except NotFound:
                     logger.info(f'Movie {name} ({year}) is missing')
@@ -214,7 +191,8 @@ def rating(plex, movies, logger: logging.Logger, progress_callback=None):
 
             else:  # old way
                 years = [year, str(int(year) - 1), str(int(year) + 1)]
-                result = movies.search(title=name, year=years)
+                # exact title hits come from the index, plex search is only needed for its fuzzy matching
+                result = index.find_title(name, years) or movies.search(title=name, year=years)
 
                 if len(result) == 1:
                     logger.info(f'Found {name} ({year}), will rate')
@@ -272,25 +250,54 @@ def rating(plex, movies, logger: logging.Logger, progress_callback=None):
                     pbar.update(1)
                     continue
 
-            movie.rate(calculated_rating)
-
-            if rs:
-                existing_rating = result[0]
-                if existing_rating != calculated_rating:
-                    logger.debug(f'Updating row: Rating: {calculated_rating} Title: {name}')
-                    update_query = 'UPDATE ratings SET rating = ? WHERE title = ?'
-                    cursor.execute(update_query, (calculated_rating, name))
-                    connection.commit()
-                    logger.debug('Updated')
-            else:
-                logger.debug(f'Inserting row row: Rating: {calculated_rating} Title: {name}')
-                insert_query = 'INSERT INTO ratings (title, rating) VALUES (?, ?)'
-                cursor.execute(insert_query, (org_title, calculated_rating))
-                connection.commit()
-                logger.debug('Inserted')
+            if config.rating_diff_sync and _is_same_rating(library.loaded_attr(movie, 'userRating'),
+                                                           calculated_rating):
+                logger.debug(f'Movie {name} is already rated as {calculated_rating} in Plex - SKIP')
+                unchanged += 1
+                pbar.update(1)
+                continue
 
+            to_rate.append((movie, calculated_rating, rated_title))
             pbar.update(1)
 
+        missing_count = len(data) - ignored - unchanged - len(to_rate)
+        publish_progress(f'Ratings to sync: {unchanged} unchanged, {len(to_rate)} to update, {missing_count} missing')
+
+        updated = 0
+        failed = 0
+        written = []
+        rated_rows = []
+        fetched = {item.ratingKey: item for item in library.fetch_items(plex, [movie for movie, _, _ in to_rate])}
+
+        pending = []
+        for movie, calculated_rating, rated_title in to_rate:
+            item = fetched.get(movie.ratingKey)
+            if item is None:
+                logger.warning(f'Movie {movie.title} ({movie.year}) is no longer in Plex - SKIP')
+                failed += 1
+                continue
+            pending.append((item, calculated_rating, rated_title))
+
+        for item, calculated_rating, rated_title, error in _write_ratings(pending):
+            if error is not None:
+                failed += 1
+                publish_progress(f'Failed to rate {item.title} ({item.year}): {error}')
+                continue
+
+            updated += 1
+            written.append((item.ratingKey, calculated_rating))
+            publish_progress(f'Rated {item.title} ({item.year}) as {calculated_rating}')
+
+            rated_rows.append((rated_title, calculated_rating))
+
+        logger.debug(f'Inserting {len(rated_rows)} rows')
+        with database.transaction() as cursor:
+            cursor.executemany('INSERT INTO ratings (title, rating) VALUES (?, ?)', rated_rows)
+            library.store_user_ratings(movies.key, written)
+        logger.debug('Inserted')
+        publish_progress(f'Ratings synced: {unchanged} unchanged, {updated} updated, {failed} failed, '
+                         f'{missing_count} missing')
+
         IgnoreMovie.store_json(to_ignore)
         MissingMovie.store_json(missing)
         autoselection.AutoSelection.store_json(autoselector)
@@ -299,6 +306,65 @@ def rating(plex, movies, logger: logging.Logger, progress_callback=None):
             progress_callback('All ratings imported')
 
 
+def _is_already_rated(title, calculated_rating):
+    select_query = 'SELECT 1 FROM ratings WHERE title = ? AND rating = ?'
+    return database.fetch_one(select_query, (title, calculated_rating)) is not None
+
+
+def _look_up_tmdb(rows, publish_progress):
+    """Resolves TMDB id and translated title of all (name, year, uri) rows up front, TMDB is queried concurrently."""
+    slugs = letterboxd.slugs_from_short_urls(uri for _, _, uri in rows)
+
+    ids = letterboxd.ids_from_slugs(slugs.values())
+
+    lookups = []
+    for name, year, uri in rows:
+        lookups.append((name, year, ids.get(slugs.get(uri), [-1, -1])[0]))
+
+    publish_progress(f'Looking up {len(lookups)} movies on TMDB')
+    results = tmdb.resolve_letterboxd_movies(lookups)
+
+    # a movie found by the title search gets the id it was resolved to, the slug had none
+    return {row: (lookup[2], None) if result is None else (result[2], result[:2])
+            for row, lookup, result in zip(rows, lookups, results)}
+
+
+def _is_transient_error(exc):
+    if isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    # plexapi raises BadRequest for every other status, the message starts with "(<status>)"
+    return isinstance(exc, BadRequest) and str(exc).startswith(('(429)', '(500)', '(502)', '(503)', '(504)'))
+
+
+def _rate_with_retries(item, value):
+    attempts = max(1, int(config.rating_write_retries) + 1)
+    for attempt in range(1, attempts + 1):
+        try:
+            item.rate(value)
+            return
+        except Exception as exc:
+            if attempt == attempts or not _is_transient_error(exc):
+                raise
+            time.sleep(RETRY_BASE_SECONDS * (2 ** (attempt - 1)))
+
+
+def _write_ratings(pending):
+    """Rate (item, rating, title) entries on a bounded thread pool, yielding them with the error or None."""
+    workers = max(1, int(config.rating_write_workers))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_rate_with_retries, item, value): (item, value, title)
+                   for item, value, title in pending}
+        for future in as_completed(futures):
+            item, value, title = futures[future]
+            yield item, value, title, future.exception()
+
+
+def _is_same_rating(plex_rating, calculated_rating):
+    if plex_rating is None:
+        return False
+    return abs(float(plex_rating) - calculated_rating) < 0.01
+
+
 def _read_ratings_csv_():
     file_path = config.ratings_path
     data = []
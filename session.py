@@ -1,3 +1,5 @@
+import json
+import os
 import re
 import time
 import random
@@ -17,13 +19,128 @@ class CloudflareChallengeError(Exception):
         self.retry_after_seconds = retry_after_seconds
 
 
+class StrategyStats:
+    """Success and latency per Cloudflare strategy, kept between runs so the working one is tried first."""
+
+    CLOUDSCRAPER = "cloudscraper"
+
+    def __init__(self, path: Optional[str] = None):
+        self._path = path
+        self._state = self._load()
+
+    def _load(self):
+        state = None
+        if self._path and os.path.exists(self._path):
+            try:
+                with open(self._path, "r", encoding="utf-8") as file:
+                    state = json.load(file)
+            except (OSError, ValueError):
+                state = None
+
+        if not isinstance(state, dict):
+            state = {}
+        state.setdefault("last_success", None)
+        state.setdefault("strategies", {})
+        return state
+
+    def _store(self):
+        if not self._path:
+            return
+
+        temp_path = f"{self._path}.tmp"
+        try:
+            directory = os.path.dirname(self._path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+            with open(temp_path, "w", encoding="utf-8") as file:
+                json.dump(self._state, file, indent=2)
+            os.replace(temp_path, self._path)
+        except OSError:
+            pass
+
+    def _entry(self, strategy):
+        return self._state["strategies"].setdefault(strategy, {
+            "successes": 0,
+            "failures": 0,
+            "latency_total": 0.0,
+            "last_success_at": None,
+            "last_failure_at": None,
+        })
+
+    @property
+    def last_success(self):
+        last = self._state["last_success"]
+        return last["strategy"] if last else None
+
+    def order(self, strategies):
+        """The last working strategy first, then the others by success rate and average latency."""
+        last = self.last_success
+        if last is not None:
+            # a strategy that failed since its last success loses its place at the front
+            last_failure_at = (self._state["strategies"].get(last) or {}).get("last_failure_at")
+            if last_failure_at is not None and last_failure_at >= self._state["last_success"]["at"]:
+                last = None
+        default_index = {strategy: index for index, strategy in enumerate(strategies)}
+
+        def _sort_key(strategy):
+            entry = self._state["strategies"].get(strategy) or {}
+            successes = entry.get("successes", 0)
+            attempts = successes + entry.get("failures", 0)
+            success_rate = successes / attempts if attempts else 0
+            latency = entry["latency_total"] / successes if successes else float("inf")
+            return strategy != last, -success_rate, latency, default_index[strategy]
+
+        return sorted(strategies, key=_sort_key)
+
+    def record_success(self, strategy, latency_seconds):
+        now = int(time.time())
+        entry = self._entry(strategy)
+        entry["successes"] += 1
+        entry["latency_total"] += latency_seconds
+        entry["last_success_at"] = now
+        self._state["last_success"] = {"strategy": strategy, "at": now}
+        self._store()
+
+    def record_failure(self, strategy):
+        entry = self._entry(strategy)
+        entry["failures"] += 1
+        entry["last_failure_at"] = int(time.time())
+        self._store()
+
+    def summary(self):
+        strategies = []
+        for strategy, entry in self._state["strategies"].items():
+            successes = entry["successes"]
+            attempts = successes + entry["failures"]
+            strategies.append({
+                "strategy": strategy,
+                "successes": successes,
+                "failures": entry["failures"],
+                "success_rate": round(successes / attempts, 3) if attempts else None,
+                "average_latency_seconds": round(entry["latency_total"] / successes, 3) if successes else None,
+                "last_success_at": entry["last_success_at"],
+                "last_failure_at": entry["last_failure_at"],
+            })
+
+        order = self.order([entry["strategy"] for entry in strategies])
+        strategies.sort(key=lambda entry: order.index(entry["strategy"]))
+
+        return {
+            "last_success": self._state["last_success"],
+            "strategies": strategies,
+        }
+
+
 class Session:
     LOGIN_URL = "https://letterboxd.com/user/login.do"
     MAIN_PAGE_URL = "https://letterboxd.com/"
     SIGN_IN_PAGE_URL = "https://letterboxd.com/sign-in/"
     EXPORT_URL = "https://letterboxd.com/data/export/"
+    SETTINGS_URL = "https://letterboxd.com/settings/"
 
     LOGIN_TIMEOUT_SECONDS = 30
+    VALIDATE_TIMEOUT_SECONDS = 15
     DOWNLOAD_TIMEOUT_SECONDS = 60
     RESPONSE_SNIPPET_LENGTH = 800
 
@@ -48,15 +165,26 @@ class Session:
         "unexpected non-json response on login",
     )
 
-    def __init__(self, username: str, password: str, use_2fa_code):
+    def __init__(self, username: str, password: str, use_2fa_code, session_path: Optional[str] = None,
+                 strategy_path: Optional[str] = None):
         if not username or not password:
             raise Exception("Username or password not set.")
 
         self._csrf = None
         self._is_logged_in = False
         self._scraper = None
+        self._username = username
+        self._session_path = session_path
+        self._strategies = StrategyStats(strategy_path)
+        self.restored = False
+
+        # a stored session skips the sign-in flow, and with it the 2FA prompt, until letterboxd expires it
+        if self._restore_session():
+            self.restored = True
+            return
 
         self.sign_in(username, password, use_2fa_code)
+        self._store_session()
 
     @staticmethod
     def _response_snippet(response, max_length=RESPONSE_SNIPPET_LENGTH):
@@ -138,18 +266,133 @@ class Session:
                     raise
         return method(url, **kwargs)
 
+    @staticmethod
+    def _iter_cookies(session):
+        # curl_cffi wraps its cookiejar and iterates names only, requests' jar is a cookiejar itself
+        return iter(getattr(session.cookies, "jar", session.cookies))
+
     def _copy_cookies(self, source_session, target_session):
         try:
-            for cookie in source_session.cookies:
+            for cookie in self._iter_cookies(source_session):
                 target_session.cookies.set(cookie.name, cookie.value, domain=cookie.domain, path=cookie.path)
         except Exception:
             pass
 
+    def _store_session(self):
+        if not self._session_path or not self._is_logged_in or not self._scraper:
+            return
+
+        cookies = [{
+            "name": cookie.name,
+            "value": cookie.value,
+            "domain": cookie.domain,
+            "path": cookie.path,
+            "secure": bool(cookie.secure),
+            "expires": cookie.expires,
+        } for cookie in self._iter_cookies(self._scraper)]
+
+        state = {
+            "username": self._username,
+            "cloudscraper": self._is_cloudscraper_session(self._scraper),
+            "saved_at": int(time.time()),
+            "cookies": cookies,
+        }
+
+        # the cookies grant access to the account, so the file is only readable by the owner
+        temp_path = f"{self._session_path}.tmp"
+        try:
+            directory = os.path.dirname(self._session_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w", encoding="utf-8") as file:
+                json.dump(state, file)
+            os.chmod(temp_path, 0o600)
+            os.replace(temp_path, self._session_path)
+        except OSError:
+            pass  # not being able to keep the session only costs a sign-in on the next run
+
+    def _load_session(self):
+        if not self._session_path or not os.path.exists(self._session_path):
+            return None
+
+        try:
+            with open(self._session_path, "r", encoding="utf-8") as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        if state.get("username") != self._username:
+            return None
+        return state
+
+    def clear_session(self):
+        if self._session_path and os.path.exists(self._session_path):
+            os.remove(self._session_path)
+
+    def _restore_session(self):
+        state = self._load_session()
+        if not state:
+            return False
+
+        if state.get("cloudscraper") and cloudscraper is not None:
+            session = self._create_cloudscraper_session()
+        else:
+            session = self._create_session()
+
+        now = time.time()
+        for cookie in state.get("cookies", []):
+            if cookie.get("expires") and cookie["expires"] < now:
+                continue
+            session.cookies.set(cookie["name"], cookie["value"], domain=cookie.get("domain", ""),
+                                path=cookie.get("path", "/"), secure=cookie.get("secure", False))
+
+        # a challenge may switch to cloudscraper, which takes the cookies over from self._scraper
+        self._scraper = session
+        try:
+            signed_in = self._is_session_signed_in()
+        except Exception:
+            # network trouble or a challenge says nothing about the session, keep it for the next run
+            self._scraper = None
+            raise
+
+        if not signed_in:
+            self._scraper = None
+            self.clear_session()
+            return False
+
+        self._is_logged_in = True
+        self._csrf = self._extract_csrf_token("", self._scraper.cookies)
+        return True
+
+    def _is_session_signed_in(self):
+        """
+        Checks the restored cookies with the settings page, which is only served to signed-in users.
+        Returns False if Letterboxd redirects to the sign-in page, raises if the answer is anything else.
+        """
+        response = self._request_with_cloudflare_recovery(
+            self._scraper,
+            "get",
+            self.SETTINGS_URL,
+            impersonate=self._impersonates(self.LOGIN_IMPERSONATES)[0],
+            headers={"Referer": self.MAIN_PAGE_URL},
+            allow_redirects=False,
+            timeout=self.VALIDATE_TIMEOUT_SECONDS,
+        )
+
+        if response.status_code == 200:
+            return True
+
+        location = response.headers.get("Location", "")
+        if response.status_code in (301, 302, 303, 307, 308) and "sign-in" in location:
+            return False
+
+        raise Exception(f"Unable to check the stored Letterboxd session: unexpected status {response.status_code}")
+
     def _switch_to_cloudscraper(self):
-        if self._scraper is not None and getattr(self._scraper, "__class__", None) is not None:
-            module_name = self._scraper.__class__.__module__
-            if module_name.startswith("cloudscraper"):
-                return self._scraper
+        if self._is_cloudscraper_session(self._scraper):
+            return self._scraper
 
         browser_session = self._create_cloudscraper_session()
         if self._scraper is not None:
@@ -167,6 +410,18 @@ class Session:
         self._raise_if_cloudflare_challenge(response)
         return response
 
+    def _login_strategies(self):
+        strategies = list(self.LOGIN_IMPERSONATES)
+        if cloudscraper is not None:
+            strategies.append(StrategyStats.CLOUDSCRAPER)
+        return self._strategies.order(strategies)
+
+    def _impersonates(self, impersonates):
+        return self._strategies.order(list(impersonates))
+
+    def _is_cloudscraper_session(self, session):
+        return session is not None and session.__class__.__module__.startswith("cloudscraper")
+
     @classmethod
     def _is_retryable_login_error(cls, exc):
         message = str(exc).lower()
@@ -224,10 +479,22 @@ class Session:
         last_error = None
         attempts_used = 0
 
+        # the strategy that got through last time goes first, so a run does not pay for the same challenges again
+        strategies = self._login_strategies()
+
         for attempt in range(1, self.MAX_LOGIN_ATTEMPTS + 1):
             attempts_used = attempt
-            impersonate = self.LOGIN_IMPERSONATES[(attempt - 1) % len(self.LOGIN_IMPERSONATES)]
-            session = self._create_session()
+            strategy = strategies[(attempt - 1) % len(strategies)]
+            started = time.monotonic()
+
+            if strategy == StrategyStats.CLOUDSCRAPER:
+                impersonate = None
+                session = self._create_cloudscraper_session()
+                self._scraper = session
+            else:
+                impersonate = strategy
+                session = self._create_session()
+                self._scraper = None
 
             try:
                 csrf = self._bootstrap_login(session, impersonate)
@@ -275,16 +542,24 @@ class Session:
 
                 self._scraper = session
                 self._csrf = response_data.get("csrf") or csrf
+
+                # a challenged profile that only got through after the switch to cloudscraper counts as failed
+                if strategy != StrategyStats.CLOUDSCRAPER and self._is_cloudscraper_session(session):
+                    self._strategies.record_failure(strategy)
+                    strategy = StrategyStats.CLOUDSCRAPER
+                self._strategies.record_success(strategy, time.monotonic() - started)
                 return self._is_logged_in
 
             except CloudflareChallengeError as exc:
                 last_error = exc
+                self._strategies.record_failure(strategy)
                 if attempt == self.MAX_LOGIN_ATTEMPTS:
                     break
                 time.sleep(self._retry_delay_seconds(attempt, exc.retry_after_seconds))
                 continue
             except Exception as exc:
                 last_error = exc
+                self._strategies.record_failure(strategy)
                 if self._is_retryable_login_error(exc) and attempt < self.MAX_LOGIN_ATTEMPTS:
                     time.sleep(self._retry_delay_seconds(attempt))
                     continue
@@ -300,9 +575,11 @@ class Session:
         last_error = None
         attempts_used = 0
 
+        impersonates = self._impersonates(self.DOWNLOAD_IMPERSONATES)
+
         for attempt in range(1, self.MAX_DOWNLOAD_ATTEMPTS + 1):
             attempts_used = attempt
-            impersonate = self.DOWNLOAD_IMPERSONATES[(attempt - 1) % len(self.DOWNLOAD_IMPERSONATES)]
+            impersonate = impersonates[(attempt - 1) % len(impersonates)]
             try:
                 response = self._request_with_cloudflare_recovery(
                     self._scraper,
@@ -331,6 +608,8 @@ class Session:
                         if chunk:
                             f.write(chunk)
 
+                # letterboxd rolls its cookies, keep the latest ones for the next run
+                self._store_session()
                 return file_name
 
             except CloudflareChallengeError as exc:
@@ -344,3 +623,7 @@ class Session:
                 break
 
         raise Exception(f"Unable to get web request after {attempts_used} attempt(s): {last_error}")
+
+
+def get_strategy_stats(path: str):
+    return StrategyStats(path).summary()
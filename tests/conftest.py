@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config  # noqa: E402  config has to be imported before tmdb, it reads tmdb.ReleaseType
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def fixture_path(name):
+    return os.path.join(FIXTURES, name)
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    """Points the database at an empty file, database.connection() reopens on the changed path."""
+    path = str(tmp_path / 'ltp.db')
+    monkeypatch.setattr(config, 'db_path', path)
+    return path
@@ -0,0 +1,68 @@
+import pytest
+
+import letterboxd
+
+from conftest import fixture_path
+
+
+def read_fixture(name):
+    with open(fixture_path(name), encoding='utf-8') as file:
+        return file.read()
+
+
+def chunked(text, size):
+    return (text[start:start + size] for start in range(0, len(text), size))
+
+
+def test_movie_page():
+    assert letterboxd.extract_ids([read_fixture('film_the_matrix.html')]) == ('603', 'tt0133093')
+
+
+def test_tv_page_has_no_tmdb_movie_id():
+    tmdb_id, _ = letterboxd.extract_ids([read_fixture('film_chernobyl.html')])
+
+    assert tmdb_id is None
+
+
+def test_page_without_imdb():
+    assert letterboxd.extract_ids([read_fixture('film_without_imdb.html')]) == ('621013', None)
+
+
+@pytest.mark.parametrize('size', [1, 7, 64, 1000])
+def test_chunk_sizes(size):
+    assert letterboxd.extract_ids(chunked(read_fixture('film_the_matrix.html'), size)) == ('603', 'tt0133093')
+
+
+@pytest.mark.parametrize('needle, body_attribute', [
+    ('data-tmdb-id="6', True),
+    ('themoviedb.org/movie/60', False),  # without the body attribute the split link is the only TMDB id
+    ('tt0133', True),
+])
+def test_ids_split_across_chunks(needle, body_attribute):
+    page = read_fixture('film_the_matrix.html')
+    if not body_attribute:
+        page = page.replace('data-tmdb-id="603" data-tmdb-type="movie"', '')
+    split = page.index(needle) + len(needle)
+
+    assert letterboxd.extract_ids([page[:split], page[split:]]) == ('603', 'tt0133093')
+
+
+def test_truncated_id_at_chunk_end_is_not_taken():
+    page = read_fixture('film_without_imdb.html').replace('/movie/621013/', '/movie/621013')
+    split = page.index('621013') + 3
+
+    assert letterboxd.extract_ids([page[:split], page[split:]]) == ('621013', None)
+
+
+def test_stops_reading_when_both_ids_are_found():
+    read = []
+
+    def chunks():
+        for chunk in chunked(read_fixture('film_the_matrix.html'), 256):
+            read.append(chunk)
+            yield chunk
+        read.append('the end of the page was read')
+
+    letterboxd.extract_ids(chunks())
+
+    assert 'the end of the page was read' not in read
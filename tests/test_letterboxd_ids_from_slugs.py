@@ -0,0 +1,46 @@
+import pytest
+
+import database
+import letterboxd
+
+
+@pytest.fixture
+def cache(db_path):
+    letterboxd.create_table()
+    with database.transaction() as cursor:
+        cursor.executemany('INSERT INTO letterboxd_cache (short_url, slug, long_url) VALUES (?, ?, ?)',
+                           [(f'https://boxd.it/{slug}', slug, f'https://letterboxd.com/film/{slug}/')
+                            for slug in ('the-matrix', 'chernobyl', 'offline')])
+
+
+@pytest.fixture
+def pages(monkeypatch):
+    """Replaces the film page request, returns the list of requested slugs."""
+    requested = []
+
+    def fake_fetch_ids(slug):
+        requested.append(slug)
+        if slug == 'offline':
+            raise ConnectionError('letterboxd not reachable')
+        return {'the-matrix': ('603', 'tt0133093'), 'chernobyl': (None, 'tt7366338')}[slug]
+
+    monkeypatch.setattr(letterboxd, 'fetch_ids', fake_fetch_ids)
+    return requested
+
+
+def test_ids_are_read_and_cached(cache, pages):
+    slugs = ['the-matrix', 'chernobyl', 'offline']
+
+    assert letterboxd.ids_from_slugs(slugs) == {
+        'the-matrix': ['603', 'tt0133093'],
+        'chernobyl': ['-1', 'tt7366338'],
+        'offline': [-1, -1],
+    }
+
+    pages.clear()
+    ids = letterboxd.ids_from_slugs(slugs)
+
+    # a page without a movie id is cached, only the failed request is repeated
+    assert pages == ['offline']
+    assert ids['the-matrix'] == ['603', 'tt0133093']
+    assert ids['chernobyl'] == ['-1', 'tt7366338']
@@ -0,0 +1,78 @@
+import gzip
+import shutil
+
+import pytest
+
+import config
+import tmdb
+
+from conftest import fixture_path
+
+
+@pytest.fixture
+def id_export(db_path, tmp_path):
+    path = tmp_path / 'movie_ids.json.gz'
+    with open(fixture_path('movie_ids.json'), 'rb') as src, gzip.open(path, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+
+    tmdb.create_table()
+    return tmdb.import_id_export(str(path))
+
+
+@pytest.fixture
+def details_requests(monkeypatch):
+    """Replaces the TMDB details request, returns the list of requested ids."""
+    release_dates = {'603': '1999-03-30', '1398': '1979-05-25', '593': '1972-03-20', '2103': '2002-11-27'}
+    requested = []
+
+    def fake_details(movie_id):
+        requested.append(str(movie_id))
+        return tmdb.MovieDetails({'id': int(movie_id), 'title': f'Movie {movie_id}',
+                                  'original_title': f'Movie {movie_id}',
+                                  'release_date': release_dates.get(str(movie_id), '')})
+
+    monkeypatch.setattr(tmdb, '__get_movie_with_extras', fake_details)
+    return requested
+
+
+def test_import_skips_broken_lines(id_export):
+    assert id_export == 5
+
+
+def test_unique_title_is_verified_with_one_request(id_export, details_requests):
+    details = tmdb.__search_id_export('the  matrix', '1999')
+
+    assert details.id == 603
+    assert details_requests == ['603']
+
+
+def test_year_off_by_one_is_accepted(id_export, details_requests):
+    # Letterboxd uses the premiere year, which may be a year before the TMDB release date
+    assert tmdb.__search_id_export('Stalker', '1978').id == 1398
+
+
+def test_year_mismatch_costs_one_request(id_export, details_requests):
+    assert tmdb.__search_id_export('The Matrix', '2021') is None
+    assert details_requests == ['603']
+
+
+def test_ambiguous_title_is_not_requested(id_export, details_requests):
+    assert tmdb.__search_id_export('Solaris', '2002') is None
+    assert details_requests == []
+
+
+def test_unknown_title_and_missing_year(id_export, details_requests):
+    assert tmdb.__search_id_export('Nope', '2000') is None
+    assert tmdb.__search_id_export('The Matrix', '') is None
+    assert details_requests == []
+
+
+def test_resolve_reuses_export_details(id_export, details_requests, monkeypatch):
+    def no_search(*args, **kwargs):
+        raise AssertionError('search must not be used on an export hit')
+
+    monkeypatch.setattr(tmdb, 'search_movie', no_search)
+    monkeypatch.setattr(config, 'tmdb_cache', False)
+
+    assert tmdb.resolve_letterboxd_movie('The Matrix', '1999') == ('Movie 603', '1999', '603')
+    assert details_requests == ['603']
@@ -1,12 +1,72 @@
+import gzip
+import hashlib
 import json
+import logging
+import threading
+import time
 import urllib.parse
 import requests
 
 import config
-import sqlite3
+import database
+import library
+import util
 
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from datetime import datetime
+from requests.adapters import HTTPAdapter
+
+REQUEST_TIMEOUT_SECONDS = 30
+MAX_RATE_LIMIT_RETRIES = 3
+ID_EXPORT_CHUNK_SIZE = 5000
+
+
+_client_lock = threading.Lock()
+_session = None
+_limiter = None
+
+
+def __client():
+    global _session, _limiter
+
+    with _client_lock:
+        rate = max(1, int(config.tmdb_requests_per_second))
+        if _limiter is None or _limiter.rate != rate:
+            _limiter = util.RateLimiter(rate)
+
+        if _session is None:
+            pool_size = max(1, int(config.tmdb_max_workers))
+            _session = requests.Session()
+            _session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+        return _session, _limiter
+
+
+def __request(url, headers):
+    session, limiter = __client()
+
+    for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+        limiter.acquire()
+        response = session.get(url, headers=headers, timeout=REQUEST_TIMEOUT_SECONDS)
+        if response.status_code != 429 or attempt == MAX_RATE_LIMIT_RETRIES:
+            return response
+
+        try:
+            retry_after = int(response.headers.get("Retry-After", 1))
+        except ValueError:
+            retry_after = 1
+        time.sleep(max(1, retry_after))
+
+
+def map_concurrent(function, items):
+    """Runs function for every item on a pool of tmdb_max_workers threads, results keep the input order."""
+    items = list(items)
+    if not items:
+        return []
+
+    with ThreadPoolExecutor(max_workers=max(1, int(config.tmdb_max_workers))) as executor:
+        return list(executor.map(function, items))
 
 
 class ReleaseType(Enum):
@@ -41,6 +101,9 @@ class MovieReleaseInfo:
     def __init__(self, data):
         self.id = data.get("id", 0)
         self.results = [ReleaseCountry(rc) for rc in data.get("results", [])]
+        # same hash for a /release_dates response and an appended release_dates block
+        self.content_hash = hashlib.sha256(
+            json.dumps(data.get("results", []), sort_keys=True).encode("utf-8")).hexdigest()
 
 
 class Movie:
@@ -116,6 +179,20 @@ class MovieDetails:
         self.vote_average = data.get("vote_average")
         self.vote_count = data.get("vote_count")
 
+        # only present when requested through append_to_response
+        self.translations = MovieTranslation(data.get("translations") or {})
+        self.release_dates = MovieReleaseInfo(data.get("release_dates") or {})
+        self.external_ids = data.get("external_ids") or {}
+
+    def get_imdb_id(self):
+        return self.imdb_id or self.external_ids.get("imdb_id")
+
+    def get_translated_title(self):
+        filtered_lang = self.translations.get_translation_by_iso()
+        if filtered_lang is None or filtered_lang.data is None or len(filtered_lang.data.title) == 0:
+            return self.original_title
+        return filtered_lang.data.title
+
 
 def __release_type_name(value):
     normalized = __normalize_release_type_value(value)
@@ -148,16 +225,6 @@ def __normalize_release_type_value(value):
     return str(value)
 
 
-def __parse_release_datetime(value):
-    if not value:
-        return None
-
-    try:
-        return datetime.fromisoformat(str(value).replace("Z", "+00:00"))
-    except Exception:
-        return None
-
-
 def __ensure_tmdb_releases_schema(cursor):
     cursor.execute("PRAGMA table_info(tmdb_releases)")
     columns = {row[1] for row in cursor.fetchall()}
@@ -169,44 +236,127 @@ def __ensure_tmdb_releases_schema(cursor):
         cursor.execute("ALTER TABLE tmdb_releases ADD COLUMN release_type_name TEXT NOT NULL DEFAULT ''")
 
 
-def __store_release_dates(movie_id: str, movie_release_info: MovieReleaseInfo):
-    connection = sqlite3.connect(config.db_path)
-    cursor = connection.cursor()
+def write_release_dates(cursor, release_infos):
+    """
+    Replaces the stored release dates of many movies at once, release_infos being (movie_id, MovieReleaseInfo)
+    pairs. Nothing is committed, the caller owns connection and transaction.
+    """
+    release_infos = [(str(movie_id), info) for movie_id, info in release_infos]
+    if not release_infos:
+        return
 
     # Keep a single authoritative snapshot per TMDB id.
-    cursor.execute('DELETE FROM tmdb_releases WHERE tmdb_id = ?', (movie_id,))
+    cursor.executemany('DELETE FROM tmdb_releases WHERE tmdb_id = ?', [(movie_id,) for movie_id, _ in release_infos])
 
     insert_query = ('INSERT INTO tmdb_releases '
                     '(title, iso_3166_1, release_id, release_type_name, release_date, tmdb_id) '
                     'VALUES (?, ?, ?, ?, ?, ?)')
 
-    for country in movie_release_info.results:
-        for rd in country.release_dates:
-            cursor.execute(insert_query, (
-                movie_id,
-                country.iso_3166_1,
-                int(rd.type),
-                __release_type_name(rd.type),
-                str(rd.release_date),
-                movie_id,
-            ))
+    cursor.executemany(insert_query, [
+        (
+            movie_id,
+            country.iso_3166_1,
+            int(rd.type),
+            __release_type_name(rd.type),
+            str(rd.release_date),
+            movie_id,
+        )
+        for movie_id, info in release_infos
+        for country in info.results
+        for rd in country.release_dates
+    ])
+
+    __write_release_summary(cursor, [movie_id for movie_id, _ in release_infos])
+
+
+def __configured_release_filter():
+    country_code = str(getattr(config, "tmdb_release_country_code", "")).strip().upper()
+    release_type_value = __normalize_release_type_value(getattr(config, "tmdb_release_type", ""))
+    return country_code, release_type_value
+
+
+def __configured_release_signature():
+    return "|".join(__configured_release_filter())
+
+
+def __write_release_summary(cursor, movie_ids):
+    """Stores the earliest release per country and type and the configured release date of the movies."""
+    movie_ids = [(str(movie_id),) for movie_id in movie_ids]
+
+    cursor.executemany('DELETE FROM tmdb_release_summary WHERE tmdb_id = ?', movie_ids)
+    cursor.executemany('INSERT INTO tmdb_release_summary '
+                       '(tmdb_id, iso_3166_1, release_id, release_type_name, release_date) '
+                       'SELECT tmdb_id, iso_3166_1, release_id, release_type_name, MIN(release_date) '
+                       'FROM tmdb_releases WHERE tmdb_id = ? GROUP BY tmdb_id, iso_3166_1, release_id', movie_ids)
 
-    connection.commit()
-    cursor.close()
-    connection.close()
+    cursor.executemany('DELETE FROM tmdb_configured_releases WHERE tmdb_id = ?', movie_ids)
+    __write_configured_release_dates(cursor, 'WHERE tmdb_id = ?', movie_ids)
 
 
-def get_release_dates(movie_id: str):
-    connection = sqlite3.connect(config.db_path)
-    cursor = connection.cursor()
+def __write_configured_release_dates(cursor, scope, scope_params):
+    # release dates are stored as "YYYY-MM-DD HH:MM:SS+00:00", so they sort as text
+    country_code, release_type_value = __configured_release_filter()
 
-    select_query = ('SELECT iso_3166_1, release_id, release_type_name, release_date '
-                    'FROM tmdb_releases WHERE tmdb_id = ? ORDER BY release_date ASC')
-    cursor.execute(select_query, (movie_id,))
-    rows = cursor.fetchall()
+    conditions = ''
+    params = []
+    if country_code:
+        conditions += ' AND UPPER(s.iso_3166_1) = ?'
+        params.append(country_code)
+    if release_type_value:
+        conditions += ' AND CAST(s.release_id AS TEXT) = ?'
+        params.append(release_type_value)
+    params.append(__configured_release_signature())
+
+    insert_query = ('INSERT OR REPLACE INTO tmdb_configured_releases (tmdb_id, release_date, config_signature) '
+                    'SELECT ids.tmdb_id, '
+                    f'(SELECT MIN(s.release_date) FROM tmdb_release_summary s WHERE s.tmdb_id = ids.tmdb_id{conditions}), ? '
+                    f'FROM (SELECT DISTINCT tmdb_id FROM tmdb_release_summary {scope}) ids')
+    cursor.executemany(insert_query, [tuple(params) + tuple(scope_param) for scope_param in scope_params])
+
+
+def __refresh_release_summaries(cursor):
+    # fills the summary of releases stored before it existed and follows changes of the release settings
+    cursor.execute('INSERT INTO tmdb_release_summary '
+                   '(tmdb_id, iso_3166_1, release_id, release_type_name, release_date) '
+                   'SELECT tmdb_id, iso_3166_1, release_id, release_type_name, MIN(release_date) FROM tmdb_releases '
+                   'WHERE tmdb_id NOT IN (SELECT tmdb_id FROM tmdb_release_summary) '
+                   'GROUP BY tmdb_id, iso_3166_1, release_id')
+
+    __write_configured_release_dates(cursor, 'WHERE tmdb_id NOT IN (SELECT tmdb_id FROM tmdb_configured_releases '
+                                             'WHERE config_signature = ?)', [(__configured_release_signature(),)])
+
+
+def __get_configured_release(movie_id: str):
+    """Returns (stored, release_date), stored being False if no releases of the movie are known."""
+    select_query = 'SELECT release_date, config_signature FROM tmdb_configured_releases WHERE tmdb_id = ?'
+    rs = database.fetch_one(select_query, (movie_id,))
+
+    if rs and rs[1] != __configured_release_signature():
+        with database.transaction() as cursor:
+            __write_configured_release_dates(cursor, 'WHERE tmdb_id = ?', [(movie_id,)])
+        rs = database.fetch_one(select_query, (movie_id,))
+
+    if not rs:
+        return False, None
+    return True, rs[0]
+
+
+def get_stored_configured_release_date(movie_id: str):
+    """Configured release date of a movie from the database only, None if unknown."""
+    if not __is_valid_id(movie_id):
+        return None
+    return __get_configured_release(str(movie_id).strip())[1]
 
-    cursor.close()
-    connection.close()
+
+def get_first_releases(movie_id: str):
+    """Return one earliest stored entry per release type, read from the precomputed summary."""
+    if not __is_valid_id(movie_id):
+        return []
+
+    # SQLite takes the other columns from the row holding the MIN()
+    select_query = ('SELECT iso_3166_1, release_id, release_type_name, MIN(release_date) '
+                    'FROM tmdb_release_summary WHERE tmdb_id = ? GROUP BY release_id ORDER BY release_id')
+    rows = database.fetch_all(select_query, (str(movie_id).strip(),))
 
     return [
         {
@@ -219,57 +369,29 @@ def get_release_dates(movie_id: str):
     ]
 
 
-def get_release_dates_for_letterboxd_movie(lb_title: str, lb_year: str):
-    connection = sqlite3.connect(config.db_path)
-    cursor = connection.cursor()
-
-    cursor.execute('SELECT tmdb_id FROM tmdb_cache WHERE lb_title = ? AND lb_year = ? LIMIT 1', (lb_title, str(lb_year)))
-    row = cursor.fetchone()
-
-    cursor.close()
-    connection.close()
-
-    if not row or not row[0]:
-        return None, []
-
-    movie_id = str(row[0])
-    return movie_id, get_release_dates(movie_id)
-
-
-def get_release_dates_for_letterboxd_movie_with_fetch(lb_title: str, lb_year: str):
+def get_first_releases_for_letterboxd_movie(lb_title: str, lb_year: str, fetch: bool = False):
     """
-    Gets release dates for a Letterboxd movie. If no cached releases exist,
-    fetches them from TMDB API on-demand.
+    Gets the earliest release per type of a Letterboxd movie. With fetch, releases that are not
+    cached yet are fetched from TMDB API on-demand.
 
     Returns: (movie_id, releases_list) tuple
     """
-    # First try to get cached releases
-    movie_id, releases = get_release_dates_for_letterboxd_movie(lb_title, lb_year)
-
-    if releases:
-        # Already have cached releases
-        return movie_id, releases
-
+    movie_id = get_tmdb_id_for_letterboxd_movie(lb_title, lb_year)
     if not movie_id:
         # No TMDB ID found, nothing to fetch
         return None, []
 
-    # Fetch release dates from API and store them
-    release_date(movie_id)
+    releases = get_first_releases(movie_id)
+    if not releases and fetch:
+        release_date(movie_id)
+        releases = get_first_releases(movie_id)
 
-    # Now get the freshly fetched and stored releases
-    return movie_id, get_release_dates(movie_id)
+    return movie_id, releases
 
 
 def get_tmdb_id_for_letterboxd_movie(lb_title: str, lb_year: str):
-    connection = sqlite3.connect(config.db_path)
-    cursor = connection.cursor()
-
-    cursor.execute('SELECT tmdb_id FROM tmdb_cache WHERE lb_title = ? AND lb_year = ? LIMIT 1', (lb_title, str(lb_year)))
-    row = cursor.fetchone()
-
-    cursor.close()
-    connection.close()
+    row = database.fetch_one('SELECT tmdb_id FROM tmdb_cache WHERE lb_title = ? AND lb_year = ? LIMIT 1',
+                             (lb_title, str(lb_year)))
 
     if not row or not row[0]:
         return None
@@ -280,109 +402,90 @@ def get_tmdb_id_for_letterboxd_movie(lb_title: str, lb_year: str):
     return movie_id
 
 
-def get_configured_release_date_for_movie(movie_id: str, refresh: bool = False):
-    if not movie_id:
-        return None
-
-    movie_id = str(movie_id).strip()
-    if not movie_id or movie_id in {"-1", "None", "null"}:
-        return None
-
-    if refresh:
-        release_date(movie_id)
-
-    releases = get_release_dates(movie_id)
-    if not releases:
-        release_date(movie_id)
-        releases = get_release_dates(movie_id)
-
-    return get_configured_release_date(releases)
+def __get_release_validator(movie_id: str):
+    # validators are only worth something while the release rows they describe are still stored
+    return database.fetch_one('SELECT etag, last_modified, content_hash FROM tmdb_release_validators v '
+                              'WHERE tmdb_id = ? AND EXISTS (SELECT 1 FROM tmdb_releases r WHERE r.tmdb_id = v.tmdb_id)',
+                              (movie_id,))
 
 
-def get_configured_release_date(releases_list):
-    """Return the earliest release date matching configured country + type."""
-    if not releases_list:
-        return None
+def __write_release_validators(cursor, validators):
+    cursor.executemany('INSERT OR REPLACE INTO tmdb_release_validators '
+                       '(tmdb_id, etag, last_modified, content_hash, checked_at) '
+                       'VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)', validators)
 
-    country_code = str(getattr(config, "tmdb_release_country_code", "")).strip().upper()
-    release_type_value = __normalize_release_type_value(getattr(config, "tmdb_release_type", ""))
 
-    candidates = []
-    for rel in releases_list:
-        rel_country = str(rel.get("country_code", "")).strip().upper()
-        rel_type = __normalize_release_type_value(rel.get("release_type_id", rel.get("release_type", "")))
-        rel_date = rel.get("release_date")
-        parsed_date = __parse_release_datetime(rel_date)
-
-        if parsed_date is None:
-            continue
-        if country_code and rel_country != country_code:
-            continue
-        if release_type_value and rel_type != release_type_value:
-            continue
-
-        candidates.append((parsed_date, str(rel_date)))
-
-    if not candidates:
-        return None
+def __fetch_release_dates(movie_id: str, validator):
+    """Conditional GET of the release dates, returns (status_code, MovieReleaseInfo or None, etag, last_modified)."""
+    url = f"https://api.themoviedb.org/3/movie/{movie_id}/release_dates"
+    headers = __get_headers()
 
-    candidates.sort(key=lambda item: item[0])
-    return candidates[0][1]
+    if validator:
+        etag, last_modified, _ = validator
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
 
+    try:
+        response = __request(url, headers)
+    except requests.RequestException:
+        return None, None, None, None
 
-def get_first_release_per_type(releases_list):
-    """Return one earliest entry per release type."""
-    if not releases_list:
-        return []
+    if response.status_code != 200:
+        return response.status_code, None, None, None
 
-    best_by_type = {}
+    return (response.status_code, MovieReleaseInfo(json.loads(response.text)),
+            response.headers.get("ETag"), response.headers.get("Last-Modified"))
 
-    for rel in releases_list:
-        rel_date = rel.get("release_date")
-        parsed_date = __parse_release_datetime(rel_date)
-        if parsed_date is None:
-            continue
 
-        rel_type_raw = rel.get("release_type_id", rel.get("release_type", ""))
-        rel_type_normalized = __normalize_release_type_value(rel_type_raw)
-        rel_type_key = rel_type_normalized or str(rel.get("release_type", ""))
-        if not rel_type_key:
-            continue
-        existing = best_by_type.get(rel_type_key)
+def refresh_release_dates(movie_ids, errors: dict = None):
+    """
+    Revalidates the release dates of many movies concurrently and writes every change in one transaction.
+    Movies TMDB reports as unchanged are not rewritten. If errors is given, it is filled with the reason
+    per movie id that could not be refreshed.
 
-        if existing is None:
-            best_by_type[rel_type_key] = (parsed_date, rel)
+    Returns: set of the movie ids TMDB answered for
+    """
+    movie_ids = list(dict.fromkeys(str(movie_id).strip() for movie_id in movie_ids if __is_valid_id(movie_id)))
+    if not movie_ids:
+        return set()
+
+    validators = {movie_id: __get_release_validator(movie_id) for movie_id in movie_ids}
+    responses = map_concurrent(lambda movie_id: __fetch_release_dates(movie_id, validators[movie_id]), movie_ids)
+
+    answered = set()
+    changed = []
+    unchanged = []
+    new_validators = []
+    for movie_id, (status_code, info, etag, last_modified) in zip(movie_ids, responses):
+        if status_code == 304:
+            unchanged.append((movie_id,))
+        elif status_code == 200:
+            validator = validators[movie_id]
+            if not validator or validator[2] != info.content_hash:
+                changed.append((movie_id, info))
+            new_validators.append((movie_id, etag, last_modified, info.content_hash))
+        else:
+            if errors is not None:
+                errors[movie_id] = f'TMDB answered {status_code}' if status_code else 'TMDB not reachable'
             continue
+        answered.add(movie_id)
 
-        existing_date, _ = existing
-        if parsed_date < existing_date:
-            best_by_type[rel_type_key] = (parsed_date, rel)
-
-    reduced = [entry[1] for entry in best_by_type.values()]
-
-    def _sort_key(entry):
-        normalized = __normalize_release_type_value(entry.get("release_type_id", entry.get("release_type", "")))
-        if normalized.isdigit():
-            return 0, int(normalized)
-        return 1, str(entry.get("release_type", ""))
+    with database.transaction() as cursor:
+        write_release_dates(cursor, changed)
+        cursor.executemany('UPDATE tmdb_release_validators SET checked_at = CURRENT_TIMESTAMP WHERE tmdb_id = ?',
+                           unchanged)
+        __write_release_validators(cursor, new_validators)
 
-    return sorted(reduced, key=_sort_key)
+    return answered
 
 
 def release_date(movie_id: str):
-    url = f"https://api.themoviedb.org/3/movie/{movie_id}/release_dates"
-    headers = __get_headers()
-    response = requests.get(url, headers=headers)
-
-    if response.status_code != 200:
+    if not refresh_release_dates([movie_id]):
         return None
 
-    data = json.loads(response.text)
-    movie_release_info = MovieReleaseInfo(data)
-    __store_release_dates(movie_id, movie_release_info)
-
-    releases = get_release_dates(movie_id)
-    return get_configured_release_date(releases)
+    return get_stored_configured_release_date(movie_id)
 
 
 def __get_headers():
@@ -397,11 +500,7 @@ def __get_headers():
 def drop_table():
     create_table_query = 'DROP TABLE tmdb_cache'
 
-    connection = sqlite3.connect(config.db_path)
-    cursor = connection.cursor()
-    cursor.execute(create_table_query)
-    connection.commit()
-    connection.close()
+    database.connection().execute(create_table_query)
 
 
 def create_table():
@@ -418,63 +517,113 @@ def create_table():
     )
     '''
 
-    connection = sqlite3.connect(config.db_path)
-    cursor = connection.cursor()
-    cursor.execute(create_table_query)
-
-    create_table_query = '''
-    CREATE TABLE IF NOT EXISTS tmdb_releases (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        title TEXT NOT NULL,
-        iso_3166_1 TEXT NOT NULL DEFAULT '',
-        release_id INTEGER NOT NULL,
-        release_type_name TEXT NOT NULL DEFAULT '',
-        release_date DATE NOT NULL,
-        tmdb_id TEXT NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    '''
-    cursor = connection.cursor()
-    cursor.execute(create_table_query)
-
-    __ensure_tmdb_releases_schema(cursor)
-
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_tmdb_releases_tmdb_id ON tmdb_releases (tmdb_id);')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_tmdb_releases_country_type ON tmdb_releases (iso_3166_1, release_id);')
-
-    connection.commit()
-    connection.close()
+    with database.transaction() as cursor:
+        cursor.execute(create_table_query)
+
+        create_table_query = '''
+        CREATE TABLE IF NOT EXISTS tmdb_releases (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            iso_3166_1 TEXT NOT NULL DEFAULT '',
+            release_id INTEGER NOT NULL,
+            release_type_name TEXT NOT NULL DEFAULT '',
+            release_date DATE NOT NULL,
+            tmdb_id TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        '''
+        cursor.execute(create_table_query)
+
+        __ensure_tmdb_releases_schema(cursor)
+
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_tmdb_releases_tmdb_id ON tmdb_releases (tmdb_id);')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_tmdb_releases_country_type ON tmdb_releases (iso_3166_1, release_id);')
+
+        create_table_query = '''
+        CREATE TABLE IF NOT EXISTS tmdb_release_summary (
+            tmdb_id TEXT NOT NULL,
+            iso_3166_1 TEXT NOT NULL,
+            release_id INTEGER NOT NULL,
+            release_type_name TEXT NOT NULL DEFAULT '',
+            release_date DATE NOT NULL,
+            PRIMARY KEY (tmdb_id, iso_3166_1, release_id)
+        )
+        '''
+        cursor.execute(create_table_query)
+
+        create_table_query = '''
+        CREATE TABLE IF NOT EXISTS tmdb_configured_releases (
+            tmdb_id TEXT PRIMARY KEY,
+            release_date DATE,
+            config_signature TEXT NOT NULL
+        )
+        '''
+        cursor.execute(create_table_query)
+        __refresh_release_summaries(cursor)
+
+        create_table_query = '''
+        CREATE TABLE IF NOT EXISTS tmdb_release_validators (
+            tmdb_id TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            content_hash TEXT,
+            checked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        '''
+        cursor.execute(create_table_query)
+
+        create_table_query = '''
+        CREATE TABLE IF NOT EXISTS tmdb_translations (
+            tmdb_id TEXT NOT NULL,
+            iso_3166_1 TEXT NOT NULL,
+            iso_639_1 TEXT NOT NULL,
+            title TEXT NOT NULL DEFAULT '',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (tmdb_id, iso_3166_1, iso_639_1)
+        )
+        '''
+        cursor.execute(create_table_query)
+
+        create_table_query = '''
+        CREATE TABLE IF NOT EXISTS tmdb_id_export (
+            tmdb_id INTEGER PRIMARY KEY,
+            original_title TEXT NOT NULL,
+            normalized_title TEXT NOT NULL,
+            popularity REAL NOT NULL DEFAULT 0,
+            adult INTEGER NOT NULL DEFAULT 0,
+            video INTEGER NOT NULL DEFAULT 0
+        )
+        '''
+        cursor.execute(create_table_query)
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_tmdb_id_export_title ON tmdb_id_export '
+                       '(normalized_title, popularity DESC);')
+
+        create_table_query = '''
+        CREATE TABLE IF NOT EXISTS tmdb_negative_cache (
+            title TEXT NOT NULL,
+            year TEXT NOT NULL,
+            variant TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (title, year, variant)
+        )
+        '''
+        cursor.execute(create_table_query)
 
 
 def reorganize_indexes():
-    connection = sqlite3.connect(config.db_path)
-    cursor = connection.cursor()
-    cursor.execute('DROP INDEX IF EXISTS idx_tmdb_id;')
-    cursor.execute('CREATE INDEX idx_tmdb_id ON tmdb_cache (tmdb_id);')
-    cursor.execute('DROP INDEX IF EXISTS idx_lb_title_year;')
-    cursor.execute('CREATE INDEX idx_lb_title_year ON tmdb_cache (lb_title, lb_year);')
-    cursor.execute('DROP INDEX IF EXISTS idx_translated_title_release_date;')
-    cursor.execute('CREATE INDEX idx_translated_title_release_date ON tmdb_cache '
-                   '(tmdb_translated_title, tmdb_release_date);')
-    connection.commit()
-
-    cursor.close()
-    connection.close()
-
-
-def __get_cached(title: str, year: int, lb: bool):
-    if lb:
-        select_query = 'SELECT * FROM tmdb_cache WHERE lb_title = ? AND lb_year = ?'
-    else:
-        select_query = 'SELECT * FROM tmdb_cache WHERE tmdb_translated_title = ? AND tmdb_release_date = ?'
+    with database.transaction() as cursor:
+        cursor.execute('DROP INDEX IF EXISTS idx_tmdb_id;')
+        cursor.execute('CREATE INDEX idx_tmdb_id ON tmdb_cache (tmdb_id);')
+        cursor.execute('DROP INDEX IF EXISTS idx_lb_title_year;')
+        cursor.execute('CREATE INDEX idx_lb_title_year ON tmdb_cache (lb_title, lb_year);')
+        cursor.execute('DROP INDEX IF EXISTS idx_translated_title_release_date;')
+        cursor.execute('CREATE INDEX idx_translated_title_release_date ON tmdb_cache '
+                       '(tmdb_translated_title, tmdb_release_date);')
 
-    connection = sqlite3.connect(config.db_path)
-    cursor = connection.cursor()
-    cursor.execute(select_query, (title, year))
 
-    rs = cursor.fetchone()
-    cursor.close()
-    connection.close()
+def __get_cached(title: str, year: int):
+    select_query = 'SELECT * FROM tmdb_cache WHERE lb_title = ? AND lb_year = ?'
+    rs = database.fetch_one(select_query, (title, year))
 
     if rs:
         data = {}
@@ -483,21 +632,53 @@ def __get_cached(title: str, year: int, lb: bool):
         cached.release_date = str(rs[4])  # 'tmdb_release_date'
         cached.id = str(rs[5])  # tmdb_id
         cached.imdb_id = str(rs[6])  # imdb_id
+        # the stored title is in the language configured back then
+        cached.title = __get_stored_translation(cached.id) or cached.title
         return cached
 
     return None
 
 
+def __write_translations(cursor, movie_id: str, movie_translation: MovieTranslation, original_title: str):
+    # All languages of a response are kept, so switching tmdb_language_code needs no request.
+    # The row without a language holds the original title and marks the movie as fetched.
+    cursor.execute('DELETE FROM tmdb_translations WHERE tmdb_id = ?', (str(movie_id),))
+
+    rows = {('', ''): original_title or ''}
+    for t in movie_translation.translations:
+        key = (t.iso_3166_1 or '', t.iso_639_1 or '')
+        if key not in rows:
+            rows[key] = (t.data.title if t.data is not None else None) or ''
+
+    insert_query = ('INSERT INTO tmdb_translations (tmdb_id, iso_3166_1, iso_639_1, title) '
+                    'VALUES (?, ?, ?, ?)')
+    cursor.executemany(insert_query, [(str(movie_id), country, language, title)
+                                      for (country, language), title in rows.items()])
+
+
+def __store_translations(movie_id: str, movie_translation: MovieTranslation, original_title: str):
+    with database.transaction() as cursor:
+        __write_translations(cursor, movie_id, movie_translation, original_title)
+
+
+def __get_stored_translation(movie_id: str):
+    """Returns the title in the configured language, the original title if there is none, or None if not stored."""
+    if movie_id is None:
+        return None
+
+    rows = database.fetch_all('SELECT iso_3166_1, title FROM tmdb_translations '
+                              'WHERE tmdb_id = ? AND iso_3166_1 IN (?, \'\') ORDER BY rowid',
+                              (str(movie_id), config.tmdb_language_code))
+
+    translated = next((title for country, title in rows if country != '' and title), None)
+    original = next((title for country, title in rows if country == ''), None)
+    return translated or original
+
+
 def get_imdb_id(movie_id: str):
     select_query = 'SELECT imdb_id FROM tmdb_cache WHERE tmdb_id = ?'
 
-    connection = sqlite3.connect(config.db_path)
-    cursor = connection.cursor()
-    cursor.execute(select_query, (movie_id,))
-
-    rs = cursor.fetchone()
-    cursor.close()
-    connection.close()
+    rs = database.fetch_one(select_query, (movie_id,))
 
     if rs:
         return str(rs[0])
@@ -507,26 +688,40 @@ def get_imdb_id(movie_id: str):
 
 def store_movie_to_cache(tmdb_translated_title: str, tmdb_release_date: str,
                          lb_title: str, lb_date: str, tmdb_id: str = None):
-    connection = sqlite3.connect(config.db_path)
-    cursor = connection.cursor()
+    select_query = 'SELECT 1 FROM tmdb_cache WHERE lb_title = ? AND lb_year = ?'
+    if database.fetch_one(select_query, (lb_title, lb_date)):
+        return
 
-    select_query = 'SELECT * FROM tmdb_cache WHERE lb_title = ? AND lb_year = ?'
-    cursor.execute(select_query, (lb_title, lb_date))
-    rs = cursor.fetchone()
-
-    if not rs:
-        details = __get_movie_details(tmdb_id)
-        imdb_id = details.imdb_id
+    # the details are fetched outside the transaction, another thread may have stored the movie meanwhile
+    details = __get_movie_details(tmdb_id)
+    imdb_id = details.imdb_id
 
+    with database.transaction() as cursor:
         insert_query = ('INSERT INTO tmdb_cache (lb_title, lb_year, '
                         'tmdb_translated_title, tmdb_release_date, tmdb_id, imdb_id) '
-                        'VALUES (?, ?, ?, ?, ?, ?)')
+                        'SELECT ?, ?, ?, ?, ?, ? '
+                        'WHERE NOT EXISTS (SELECT 1 FROM tmdb_cache WHERE lb_title = ? AND lb_year = ?)')
         cursor.execute(insert_query, (lb_title, lb_date,
-                                      tmdb_translated_title, tmdb_release_date, tmdb_id, imdb_id))
-        connection.commit()
+                                      tmdb_translated_title, tmdb_release_date, tmdb_id, imdb_id, lb_title, lb_date))
+
+
+def __store_movie_with_extras(details: MovieDetails, tmdb_translated_title: str, tmdb_release_date: str,
+                              lb_title: str, lb_date: str, tmdb_id: str):
+    """Writes the tmdb_cache row and the release dates of a combined details response in one transaction."""
+    with database.transaction() as cursor:
+        select_query = 'SELECT 1 FROM tmdb_cache WHERE lb_title = ? AND lb_year = ?'
+        cursor.execute(select_query, (lb_title, lb_date))
+        if not cursor.fetchone():
+            insert_query = ('INSERT INTO tmdb_cache (lb_title, lb_year, '
+                            'tmdb_translated_title, tmdb_release_date, tmdb_id, imdb_id) '
+                            'VALUES (?, ?, ?, ?, ?, ?)')
+            cursor.execute(insert_query, (lb_title, lb_date,
+                                          tmdb_translated_title, tmdb_release_date, tmdb_id, details.get_imdb_id()))
 
-    cursor.close()
-    connection.close()
+        write_release_dates(cursor, [(details.id, details.release_dates)])
+        __write_release_validators(cursor, [(str(details.id), None, None, details.release_dates.content_hash)])
+        if details.translations.translations:
+            __write_translations(cursor, str(details.id), details.translations, details.original_title)
 
 
 def invalidate_cache():
@@ -541,37 +736,190 @@ def invalidate_cache():
     if days < 0:
         days = 0
 
-    connection = sqlite3.connect(config.db_path)
-    cursor = connection.cursor()
+    with database.transaction() as cursor:
+        cursor.execute(
+            "DELETE FROM tmdb_cache WHERE created_at < DATETIME('now', ?)",
+            (f"-{days} days",),
+        )
+        cursor.execute(
+            "DELETE FROM tmdb_releases WHERE created_at < DATETIME('now', ?)",
+            (f"-{days} days",),
+        )
+        cursor.execute(
+            "DELETE FROM tmdb_translations WHERE created_at < DATETIME('now', ?)",
+            (f"-{days} days",),
+        )
+        cursor.execute('DELETE FROM tmdb_release_summary WHERE tmdb_id NOT IN (SELECT tmdb_id FROM tmdb_releases)')
+        cursor.execute('DELETE FROM tmdb_configured_releases WHERE tmdb_id NOT IN (SELECT tmdb_id FROM tmdb_releases)')
+
+
+def __negative_cache_days():
+    try:
+        days = int(config.tmdb_negative_cache_days)
+    except Exception:
+        days = 14
 
-    cursor.execute(
-        "DELETE FROM tmdb_cache WHERE created_at < DATETIME('now', ?)",
-        (f"-{days} days",),
-    )
-    cursor.execute(
-        "DELETE FROM tmdb_releases WHERE created_at < DATETIME('now', ?)",
-        (f"-{days} days",),
-    )
-    connection.commit()
+    return max(days, 0)
+
+
+def __negative_cache_key(title: str, year):
+    # a search with and without a year are different queries, each can miss on its own
+    variant = 'year' if year is not None else 'title'
+    return title, '' if year is None else str(year), variant
 
-    cursor.close()
-    connection.close()
+
+def __is_negative_cached(title: str, year):
+    select_query = ("SELECT 1 FROM tmdb_negative_cache WHERE title = ? AND year = ? AND variant = ? "
+                    "AND created_at >= DATETIME('now', ?)")
+
+    rs = database.fetch_one(select_query, (*__negative_cache_key(title, year), f"-{__negative_cache_days()} days"))
+    return rs is not None
+
+
+def __store_negative(title: str, year):
+    database.connection().execute('INSERT OR REPLACE INTO tmdb_negative_cache (title, year, variant, created_at) '
+                                  'VALUES (?, ?, ?, CURRENT_TIMESTAMP)', __negative_cache_key(title, year))
+
+
+def get_negative_cache():
+    """Returns the searches TMDB had no result for, newest first."""
+    rows = database.fetch_all("SELECT title, year, variant, created_at, created_at < DATETIME('now', ?) "
+                              "FROM tmdb_negative_cache ORDER BY created_at DESC, title",
+                              (f"-{__negative_cache_days()} days",))
+
+    return [{
+        "title": row[0],
+        "year": row[1],
+        "variant": row[2],
+        "created_at": row[3],
+        "expired": bool(row[4]),
+    } for row in rows]
+
+
+def purge_negative_cache(title: str = None, year: str = None, expired_only: bool = False):
+    """
+    Deletes negative cache entries, all of them, only the expired ones or those of one title (and year).
+    Returns: amount of deleted entries
+    """
+    delete_query = 'DELETE FROM tmdb_negative_cache WHERE 1 = 1'
+    params = []
+
+    if title:
+        delete_query += ' AND title = ?'
+        params.append(title)
+        if year:
+            delete_query += ' AND year IN (?, \'\')'
+            params.append(str(year))
+    if expired_only:
+        delete_query += " AND created_at < DATETIME('now', ?)"
+        params.append(f"-{__negative_cache_days()} days")
+
+    with database.transaction() as cursor:
+        cursor.execute(delete_query, params)
+        return cursor.rowcount
+
+
+def __iter_id_export(path: str):
+    with gzip.open(path, 'rt', encoding='utf-8') as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+                tmdb_id = int(entry["id"])
+            except (ValueError, KeyError, TypeError):
+                continue
+
+            title = entry.get("original_title") or ""
+            if not title:
+                continue
+
+            yield (tmdb_id, title, library.normalize_title(title), float(entry.get("popularity") or 0),
+                   int(bool(entry.get("adult"))), int(bool(entry.get("video"))))
+
+
+def import_id_export(path: str, logger: logging.Logger = None):
+    """
+    Loads a TMDB daily id export (movie_ids_MM_DD_YYYY.json.gz) into tmdb_id_export.
+    The file is read line by line and written in chunks, so memory use does not grow with its size.
+
+    Returns: amount of imported movies
+    """
+    insert_query = ('INSERT OR REPLACE INTO tmdb_id_export '
+                    '(tmdb_id, original_title, normalized_title, popularity, adult, video) '
+                    'VALUES (?, ?, ?, ?, ?, ?)')
+
+    imported = 0
+    chunk = []
+    for row in __iter_id_export(path):
+        chunk.append(row)
+        if len(chunk) >= ID_EXPORT_CHUNK_SIZE:
+            # one transaction per chunk, so running syncs are not blocked for the whole import
+            with database.transaction() as cursor:
+                cursor.executemany(insert_query, chunk)
+            imported += len(chunk)
+            chunk = []
+            if logger:
+                logger.info(f'Imported {imported} TMDB ids')
+
+    with database.transaction() as cursor:
+        cursor.executemany(insert_query, chunk)
+    imported += len(chunk)
+
+    if logger:
+        logger.info(f'Imported {imported} TMDB ids from {path}')
+    return imported
+
+
+def __get_id_export_candidates(title: str):
+    # two rows are enough to tell whether the title is unique
+    rows = database.fetch_all('SELECT tmdb_id FROM tmdb_id_export WHERE normalized_title = ? AND video = 0 LIMIT 2',
+                              (library.normalize_title(title),))
+
+    return [str(row[0]) for row in rows]
+
+
+def __search_id_export(title: str, year):
+    """
+    Finds a movie through the imported id export instead of searching TMDB. Only titles that are unique
+    in the export are used, the year is verified with the details request that is needed anyway.
+
+    Returns: MovieDetails including the appended extras or None
+    """
+    if not str(year).isdigit():
+        return None
+
+    candidates = __get_id_export_candidates(title)
+    if len(candidates) != 1:
+        return None
+
+    details = __get_movie_with_extras(candidates[0])
+    if details is None or details.id is None:
+        return None
+
+    # lb is using premiere dates, so the year may be off by one
+    release_year = (details.release_date or '')[:4]
+    if not release_year.isdigit() or abs(int(release_year) - int(year)) > 1:
+        return None
+
+    return details
 
 
 def auth():
     url = "https://api.themoviedb.org/3/authentication"
     headers = __get_headers()
 
-    response = requests.get(url, headers=headers)
+    response = __request(url, headers)
     return "Success." in response.text
 
 
 def search_movie(title: str, year: int = None):
     if config.tmdb_cache:
-        found = __get_cached(title, year, True)
+        found = __get_cached(title, year)
         if found:
             return [found]
 
+        if __is_negative_cached(title, year):
+            return []
+
     compiled_title = urllib.parse.quote(title)
     if year is not None:
         url = (f'https://api.themoviedb.org/3/search/movie?query={compiled_title}&include_adult=true'
@@ -580,7 +928,7 @@ def search_movie(title: str, year: int = None):
         url = (f'https://api.themoviedb.org/3/search/movie?query={compiled_title}&include_adult=true'
                f'&language=en-US&page=1')
     headers = __get_headers()
-    response = requests.get(url, headers=headers)
+    response = __request(url, headers)
 
     if response.status_code != 200:
         return []
@@ -588,6 +936,9 @@ def search_movie(title: str, year: int = None):
     data = json.loads(response.text)
     movies = MovieResponse(data)
 
+    if not movies.results and config.tmdb_cache:
+        __store_negative(title, year)
+
     return movies.results
 
 
@@ -597,7 +948,7 @@ def __get_movie_details(movie_id: str):
     url = f"https://api.themoviedb.org/3/movie/{movie_id}?language=en-US"
     headers = __get_headers()
 
-    response = requests.get(url, headers=headers)
+    response = __request(url, headers)
 
     data = json.loads(response.text)
     details = MovieDetails(data)
@@ -605,21 +956,90 @@ def __get_movie_details(movie_id: str):
     return details
 
 
+def __get_movie_with_extras(movie_id: str):
+    """Details, translations, release dates and external ids of a movie in a single request."""
+    url = (f"https://api.themoviedb.org/3/movie/{movie_id}?language=en-US"
+           f"&append_to_response=translations,release_dates,external_ids")
+    headers = __get_headers()
+    response = __request(url, headers)
+
+    if response.status_code != 200:
+        return None
+
+    data = json.loads(response.text)
+    return MovieDetails(data)
+
+
 def translation(movie: Movie):
     if config.tmdb_cache:
-        found = __get_cached(movie.title, movie.release_date, False)
+        found = __get_stored_translation(movie.id)
         if found:
-            return found.title
+            return found
 
     url = f"https://api.themoviedb.org/3/movie/{movie.id}/translations"
     headers = __get_headers()
-    response = requests.get(url, headers=headers)
+    response = __request(url, headers)
 
     data = json.loads(response.text)
     movie_translation = MovieTranslation(data)
+    if config.tmdb_cache and response.status_code == 200:
+        __store_translations(movie.id, movie_translation, movie.original_title)
 
     filtered_lang = movie_translation.get_translation_by_iso()
     if filtered_lang is None or filtered_lang.data is None or len(filtered_lang.data.title) == 0:
         return movie.original_title
 
     return filtered_lang.data.title
+
+
+def __is_valid_id(movie_id):
+    return movie_id is not None and str(movie_id).strip() not in {"", "-1", "None", "null"}
+
+
+def resolve_letterboxd_movie(title: str, year: str, tmdb_id: str = None):
+    """
+    Looks up a Letterboxd movie on TMDB by its id, or by title if the id is unknown,
+    and caches the translated title.
+
+    Returns: (translated_title, release_year, tmdb_id) tuple or None if TMDB does not know the movie,
+    tmdb_id being the id the movie was resolved to, also when it was found by the title search
+    """
+    if config.tmdb_cache:
+        cached = __get_cached(title, year)
+        if cached:
+            return cached.title, cached.release_date, cached.id
+
+    # the id from the Letterboxd slug is authoritative, title search is only the fallback
+    details = __get_movie_with_extras(tmdb_id) if __is_valid_id(tmdb_id) else None
+
+    if details is None:
+        details = __search_id_export(title, year)
+
+    if details is None:
+        tmdb_movies = search_movie(title=title, year=year)
+        if len(tmdb_movies) == 0:
+            tmdb_movies = search_movie(title=title)
+            if len(tmdb_movies) == 0:
+                return None
+
+        tmdb_movie = tmdb_movies[0]
+        details = __get_movie_with_extras(tmdb_movie.id)
+
+        if details is None:
+            translated_title = translation(tmdb_movie)
+            release_year = tmdb_movie.release_date[:4]
+            if release_year != '':  # could happen if there is no rls-date on tmdb
+                store_movie_to_cache(translated_title, release_year, title, year, tmdb_movie.id)
+            return translated_title, release_year, str(tmdb_movie.id)
+
+    translated_title = details.get_translated_title()
+    release_year = (details.release_date or '')[:4]
+    if release_year != '':  # could happen if there is no rls-date on tmdb
+        __store_movie_with_extras(details, translated_title, release_year, title, year, str(details.id))
+
+    return translated_title, release_year, str(details.id)
+
+
+def resolve_letterboxd_movies(movies):
+    """Concurrent resolve_letterboxd_movie for (title, year, tmdb_id) tuples, results keep the input order."""
+    return map_concurrent(lambda movie: resolve_letterboxd_movie(*movie), movies)
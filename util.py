@@ -1,5 +1,7 @@
 import csv
 import os
+import threading
+import time
 
 
 def resolve_existing_path(file_path):
@@ -78,3 +80,26 @@ def remove_from_missing_if_needed(missing, names):
 
     return [movie for movie in missing if _normalize_title(movie.name) not in names_set]
 
+
+class RateLimiter:
+    """Token bucket, refilled with `rate` tokens per second up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
@@ -1,13 +1,17 @@
 import logging
 import config
 import datetime
+import time
 import autoselection
 import csv
 import letterboxd
+import library
+import plexclient
 import tmdb
 import util
 from selector import choose_movie
 
+from concurrent.futures import ThreadPoolExecutor
 from plexapi.exceptions import NotFound, BadRequest
 from missingmovie import MissingMovie
 from ignoremovie import IgnoreMovie
@@ -16,11 +20,21 @@ from movie import Movie
 from tqdm import tqdm
 
 
-def _refresh_release_date_for_missing(tmdb_id):
+def _refresh_release_dates_for_missing(pending, logger):
+    """Refresh the release dates of all (missing movie, tmdb id) pairs with one batch and one commit."""
+    if not pending:
+        return
+
     try:
-        return tmdb.get_configured_release_date_for_movie(tmdb_id, refresh=True)
-    except Exception:
-        return None
+        tmdb.refresh_release_dates(tmdb_id for _, tmdb_id in pending)
+    except Exception as e:
+        logger.warning(f'Could not refresh release dates of missing movies: {e}')
+
+    for movie, tmdb_id in pending:
+        try:
+            movie.release_date = tmdb.get_stored_configured_release_date(tmdb_id)
+        except Exception:
+            movie.release_date = None
 
 
 def watchlist(plex, movies, logger: logging.Logger, progress_callback=None):
@@ -30,6 +44,7 @@ def watchlist(plex, movies, logger: logging.Logger, progress_callback=None):
     autoselector = autoselection.AutoSelection.load_json() or []
 
     logger.info("Started importing watchlist")
+    index = library.load_index(plex, movies, logger)
 
     data = __read_watchlist_csv__(config.watchlist_path)
     if config.include_watched_not_rated:
@@ -41,8 +56,16 @@ def watchlist(plex, movies, logger: logging.Logger, progress_callback=None):
         sorted_data = data
 
     missing = MissingMovie.load_json() or []
+    release_date_refreshes = []
     to_add = []
 
+    tmdb_lookups = {}
+    if config.tmdb_use_api:
+        to_look_up = [(name, year, uri) for name, year, uri in sorted_data
+                      if name != '' and year != '' and int(year) <= current_year
+                      and not any(name == existing.name and year == existing.year for existing in to_ignore)]
+        tmdb_lookups = __look_up_tmdb__(to_look_up, logger, progress_callback)
+
     with tqdm(total=len(sorted_data), unit='Movies') as pbar:
         for name, year, uri in sorted_data:
             skip = False
@@ -69,37 +92,22 @@ def watchlist(plex, movies, logger: logging.Logger, progress_callback=None):
                 continue
 
             if config.tmdb_use_api:
-                logger.debug(f'Trying to look it up on tmdb')
-                slug = letterboxd.slug_from_short_url(uri)
-                ids = letterboxd.ids_from_slug(slug)
-                tmdb_id = ids[0]
+                tmdb_id, tmdb_result = tmdb_lookups[(name, year, uri)]
                 logger.info(f'Got TMDB id {tmdb_id}')
 
-                tmdb_movies = tmdb.search_movie(title=name, year=year)
-                if len(tmdb_movies) == 0:
-                    logger.info('Searched TMDB, was not able to find.')
-                    tmdb_movies = tmdb.search_movie(title=name)
-                    if len(tmdb_movies) == 0:
-                        logger.debug(f'Movie {combination.name} ({combination.year}) not found on TMDB, added to missing list')
-                        combination.release_date = _refresh_release_date_for_missing(tmdb_id)
-                        missing.append(combination)
-                        continue
+                if tmdb_result is None:
+                    logger.debug(f'Movie {combination.name} ({combination.year}) not found on TMDB, added to missing list')
+                    release_date_refreshes.append((combination, tmdb_id))
+                    missing.append(combination)
+                    continue
 
-                tmdb_movie = tmdb_movies[0]
                 logger.info(f'Searched TMDB {name} ({year})')
-                org_title = name
-                org_year = year
-
-                # I think only tmdb_id is needed at this state. Whatever - this is not the bottleneck.
-                name = tmdb.translation(tmdb_movie)
-                year = tmdb_movie.release_date[:4]
+                name, year = tmdb_result
 
                 if year == '':  # could happen if there is no rls-date on tmdb
                     pbar.update(1)
                     continue
 
-                tmdb.store_movie_to_cache(name, year, org_title, org_year, tmdb_id)
-
             manually_mapped = util.find_movie_by_letterboxd_title(mapping, combination)
 
             was_missing_names.append(combination.name)
@@ -127,74 +135,46 @@ def watchlist(plex, movies, logger: logging.Logger, progress_callback=None):
 
             if config.tmdb_use_api:
                 try:
-                    # try to search the movie the normal way first. compare guid then to avoid using movies.getGuid
-                    # because this function is really, really slow af
-                    # search(): 8 - 12 movies/s <> getGuid(): 2 - 4 movies/s
-                    tmdb_result = movies.search(title=name)
-                    logger.info(f'Found multiple movies for {name} ({year})')
+                    matches = index.find_tmdb(tmdb_id)
 
-                    if len(tmdb_result) > 0:
-                        matches = []
+                    if len(matches) == 1:
+                        selected = matches[0]
+                        logger.info(f'Found {name} ({year}), will add to watchlist')
+                        to_add.append(selected)
+                        missing = util.remove_from_missing_if_needed(missing, was_missing_names)
 
-                        for result in tmdb_result:
-                            guids = getattr(result, 'guids', [])
-                            if any(f"tmdb://{tmdb_id}" in str(guid.id) for guid in guids):
-                                matches.append(result)
+                    elif len(matches) > 1:
+                        logger.info(f'Found multiple possible matches for {name} ({year})')
+                        selected = choose_movie(
+                            autoselector, combination, matches, logger,
+                            web_mode=config.web_mode
+                        )
 
-                        if len(matches) == 1:
-                            selected = matches[0]
-                            logger.info(f'Found {name} ({year}), will add to watchlist')
+                        if selected:
+                            logger.info(f'User selected {selected.title} ({selected.year})')
                             to_add.append(selected)
+                            was_missing_names.append(selected.title)
                             missing = util.remove_from_missing_if_needed(missing, was_missing_names)
-
-                        elif len(matches) > 1:
-                            logger.info(f'Found multiple possible matches for {name} ({year})')
-                            selected = choose_movie(
-                                autoselector, combination, matches, logger,
-                                web_mode=config.web_mode
-                            )
-
-                            if selected:
-                                logger.info(f'User selected {selected.title} ({selected.year})')
-                                to_add.append(selected)
-                                was_missing_names.append(selected.title)
-                                missing = util.remove_from_missing_if_needed(missing, was_missing_names)
-                            else:
-                                logger.info(f'User skipped selection for {name} ({year})')
-                                raise NotFound  # treat as missing for skip logic
-
                         else:
-                            # No matching TMDB GUIDs found, fallback to slower getGuid()
-                            logger.debug(f'No exact GUID match found for {name} ({year}), trying TMDB GUID lookup...')
-                            result = movies.getGuid(f'tmdb://{tmdb_id}')
-                            if result:
-                                logger.info(f'Found {name} ({year}) via TMDB ID, will add to watchlist')
-                                to_add.append(result)
-                                missing = util.remove_from_missing_if_needed(missing, was_missing_names)
-                            else:
-                                raise NotFound
+                            logger.info(f'User skipped selection for {name} ({year})')
+                            raise NotFound  # treat as missing for skip logic
+
                     else:
-                        # No Plex matches at all, fallback to TMDB GUID directly
-                        result = movies.getGuid(f'tmdb://{tmdb_id}')
-                        if result:
-                            logger.info(f'Found {name} ({year}) via TMDB ID, will add to watchlist')
-                            to_add.append(result)
-                            missing = util.remove_from_missing_if_needed(missing, was_missing_names)
-                        else:
-                            raise NotFound
+                        raise NotFound
                 except NotFound:
                     logger.info(f'Movie {name} ({year}) is missing')
                     for existing in missing:
                         if combination.name == existing.name and combination.year == existing.year:
                             logger.debug(f'Refreshing release_date for movie {existing.name} ({existing.year})')
-                            existing.release_date = _refresh_release_date_for_missing(tmdb_id)
+                            release_date_refreshes.append((existing, tmdb_id))
                             break
                     else:
                         logger.debug(f'Movie {combination.name} ({combination.year}) added to missing list')
-                        combination.release_date = _refresh_release_date_for_missing(tmdb_id)
+                        release_date_refreshes.append((combination, tmdb_id))
                         missing.append(combination)
             else:  # old way
-                result = movies.search(title=name, year=years)
+                # exact title hits come from the index, plex search is only needed for its fuzzy matching
+                result = index.find_title(name, years) or movies.search(title=name, year=years)
 
                 if len(result) == 1:
                     logger.info(f'Found {name} ({year}), will add to watchlist')
@@ -245,7 +225,11 @@ def watchlist(plex, movies, logger: logging.Logger, progress_callback=None):
 
             pbar.update(1)
 
-    if config.use_playlist_as_watchlist:
+    _refresh_release_dates_for_missing(release_date_refreshes, logger)
+    to_add = library.fetch_items(plex, to_add)
+    watchlist_movies = list(to_add)  # the playlist filters below do not apply to the builtin watchlist
+
+    if config.use_playlist_as_watchlist and not config.playlist_reconcile:
         try:
             playlist = plex.playlist(config.watchlist_name_to_create)
             playlist.delete()
@@ -257,19 +241,27 @@ def watchlist(plex, movies, logger: logging.Logger, progress_callback=None):
             pbar.write("\nPlaylist not existing yet. No worries, nothing to do.")
             progress_callback("Playlist not existing yet. No worries, nothing to do.")
 
-
+    if config.use_playlist_as_watchlist:
         if config.ignore_movies_in_existing_watchlist:
+            started = time.monotonic()
             try:
                 existing_playlist = plex.playlist(config.existing_watchlist_name)
-
-                to_add_cleaned = []
-                for m in to_add:
-                    is_in_playlist = any(
-                        movie.title == m.title and movie.year == m.year for movie in existing_playlist.items())
-                    if not is_in_playlist:
-                        to_add_cleaned.append(m)
-
-                to_add = to_add_cleaned
+                existing_items = existing_playlist.items()
+
+                existing_keys = {item.ratingKey for item in existing_items}
+                existing_guids = {guid for item in existing_items for guid in library.item_guids(item)}
+                existing_titles = {(library.normalize_title(item.title), str(item.year)) for item in existing_items}
+
+                count_before = len(to_add)
+                to_add = [m for m in to_add
+                          if m.ratingKey not in existing_keys
+                          and not any(guid in existing_guids for guid in library.item_guids(m))
+                          and (library.normalize_title(m.title), str(m.year)) not in existing_titles]
+
+                message = (f'Skipped {count_before - len(to_add)} movies already in existing watchlist '
+                           f'({len(existing_items)} items) in {time.monotonic() - started:.2f}s')
+                logger.info(message)
+                progress_callback(message)
             except NotFound:
                 logger.warning('Existing watchlist not found!')
                 pbar.write("\nExisting watchlist not found!")
@@ -278,20 +270,21 @@ def watchlist(plex, movies, logger: logging.Logger, progress_callback=None):
         if config.sort_by_title:
             to_add = __sort_playlist_ignore_words__(to_add)
 
-        if len(to_add) > 0:
-            plex.createPlaylist(title='Letterboxd Watchlist', items=to_add)
+        if config.playlist_reconcile:
+            __reconcile_playlist__(plex, to_add, logger, progress_callback)
+        elif len(to_add) > 0:
+            plex.createPlaylist(title=config.watchlist_name_to_create, items=to_add)
             logger.info('Watchlist created')
         else:
             logger.info('Nothing to add.')
 
     if config.use_builtin_watchlist:
-        account = plex.myPlexAccount()
-        for movie in to_add:
-            try:
-                account.addToWatchlist(movie)
-                logger.debug(f'Internal Watchlist added {movie.title} ({movie.year})')
-            except BadRequest:
-                logger.info('Internal Watchlist already on watchlist - ignore.')
+        keep_guids, keep_titles = __letterboxd_watchlist_keys__(sorted_data, tmdb_lookups)
+        try:
+            __sync_builtin_watchlist__(plex, watchlist_movies, keep_guids, keep_titles, logger, progress_callback)
+        except Exception as e:
+            logger.warning(f'Internal Watchlist could not be synchronized: {e}')
+            progress_callback(f'Internal Watchlist could not be synchronized: {e}')
 
     IgnoreMovie.store_json(to_ignore)
     MissingMovie.store_json(missing)
@@ -300,6 +293,206 @@ def watchlist(plex, movies, logger: logging.Logger, progress_callback=None):
     progress_callback("Synchronized Watchlist")
 
 
+def __look_up_tmdb__(rows, logger, progress_callback):
+    """Resolves TMDB id and translated title of all (name, year, uri) rows up front, TMDB is queried concurrently."""
+    slugs = letterboxd.slugs_from_short_urls(uri for _, _, uri in rows)
+
+    ids = letterboxd.ids_from_slugs(slugs.values())
+
+    lookups = []
+    for name, year, uri in rows:
+        lookups.append((name, year, ids.get(slugs.get(uri), [-1, -1])[0]))
+
+    logger.info(f'Looking up {len(lookups)} movies on TMDB')
+    progress_callback(f'Looking up {len(lookups)} movies on TMDB')
+    results = tmdb.resolve_letterboxd_movies(lookups)
+
+    # a movie found by the title search gets the id it was resolved to, the slug had none
+    return {row: (lookup[2], None) if result is None else (result[2], result[:2])
+            for row, lookup, result in zip(rows, lookups, results)}
+
+
+def __letterboxd_watchlist_keys__(rows, tmdb_lookups):
+    """GUIDs and (title, year) pairs of every movie on the Letterboxd watchlist, owned in Plex or not."""
+    guids = set()
+    titles = set()
+    for name, year, uri in rows:
+        titles.add((library.normalize_title(name), str(year)))
+
+        tmdb_id, tmdb_result = tmdb_lookups.get((name, year, uri), (None, None))
+        if tmdb_id not in (None, '', -1, '-1'):
+            guids.add(f'tmdb://{tmdb_id}')
+        if tmdb_result:
+            titles.add((library.normalize_title(tmdb_result[0]), str(tmdb_result[1])))
+    return guids, titles
+
+
+def __is_on_letterboxd_watchlist__(item, keep_guids, keep_titles):
+    if any(guid in keep_guids for guid in library.item_guids(item)):
+        return True
+
+    # lb is using premiere dates, so the year may be off by one
+    title = library.normalize_title(library.loaded_attr(item, 'title'))
+    year = library.loaded_attr(item, 'year')
+    if year is None:
+        return (title, '') in keep_titles
+    return any((title, str(int(year) + offset)) in keep_titles for offset in (-1, 0, 1))
+
+
+def __sync_builtin_watchlist__(plex, movies, keep_guids, keep_titles, logger, progress_callback):
+    account = plex.myPlexAccount()
+    current = account.watchlist(libtype='movie', includeGuids=1)
+    current_guids = {item.guid for item in current}
+
+    wanted = {}
+    for movie in movies:
+        guid = library.loaded_attr(movie, 'guid')
+        if guid and guid.startswith('plex://'):
+            wanted.setdefault(guid, movie)
+        else:
+            logger.info(f'Internal Watchlist skipped {movie.title} ({movie.year}), no Plex GUID')
+
+    to_add = [movie for guid, movie in wanted.items() if guid not in current_guids]
+    to_remove = []
+    if config.builtin_watchlist_remove_missing:
+        # only movies that left the Letterboxd watchlist, not the ones that are just not in the library
+        to_remove = [item for item in current
+                     if item.guid not in wanted and not __is_on_letterboxd_watchlist__(item, keep_guids, keep_titles)]
+
+    added = __update_builtin_watchlist__(__watchlist_action__(account, 'addToWatchlist'), 'add', to_add, logger)
+    removed = __update_builtin_watchlist__(__watchlist_action__(account, 'removeFromWatchlist'), 'remove',
+                                           to_remove, logger)
+
+    message = f'Internal Watchlist synchronized: {added} added, {removed} removed'
+    logger.info(message)
+    progress_callback(message)
+
+
+def __watchlist_action__(account, action):
+    # account.addToWatchlist() asks plex.tv whether each item is on the watchlist before the change,
+    # that is already known from the diff, so only the action itself is sent (same endpoint as plexapi)
+    put = plexclient.get_session().put
+
+    def update(item):
+        rating_key = item.guid.rsplit('/', 1)[-1]
+        account.query(f'{account.DISCOVER}/actions/{action}?ratingKey={rating_key}', method=put)
+
+    return update
+
+
+def __update_builtin_watchlist__(update, action, items, logger):
+    # the items are already diffed against the watchlist, a failed item is logged and must not stop the sync
+    done = 0
+    batch_size = max(1, int(config.builtin_watchlist_batch_size))
+    with ThreadPoolExecutor(max_workers=batch_size) as executor:
+        for start in range(0, len(items), batch_size):
+            batch = items[start:start + batch_size]
+            for item, future in [(item, executor.submit(update, item)) for item in batch]:
+                try:
+                    future.result()
+                    done += 1
+                    logger.debug(f'Internal Watchlist {action} {item.title} ({item.year})')
+                except BadRequest as exc:
+                    logger.info(f'Internal Watchlist {action} failed for {item.title} ({item.year}): {exc}')
+                except Exception as exc:
+                    logger.warning(f'Internal Watchlist {action} failed for {item.title} ({item.year}): {exc}')
+    return done
+
+
+def __reconcile_playlist__(plex, items, logger, progress_callback):
+    try:
+        playlist = plex.playlist(config.watchlist_name_to_create)
+    except NotFound:
+        if len(items) > 0:
+            plex.createPlaylist(title=config.watchlist_name_to_create, items=items)
+            logger.info('Watchlist created')
+            progress_callback(f'Watchlist created with {len(items)} movies')
+        else:
+            logger.info('Nothing to add.')
+        return
+
+    desired = []
+    desired_keys = set()
+    for item in items:
+        if item.ratingKey not in desired_keys:
+            desired_keys.add(item.ratingKey)
+            desired.append(item)
+
+    current = playlist.items()
+    current_keys = {item.ratingKey for item in current}
+
+    to_remove = [item for item in current if item.ratingKey not in desired_keys]
+    to_append = [item for item in desired if item.ratingKey not in current_keys]
+
+    if to_remove:
+        playlist.removeItems(to_remove)
+    if to_append:
+        playlist.addItems(to_append)
+
+    moved = 0
+    if config.sort_by_title:
+        if to_remove or to_append:
+            playlist.reload()
+            current = playlist.items()
+        moved = __reorder_playlist__(playlist, current, [item.ratingKey for item in desired])
+
+    message = f'Watchlist reconciled: {len(to_append)} added, {len(to_remove)} removed, {moved} moved'
+    logger.info(message)
+    progress_callback(message)
+
+
+def __reorder_playlist__(playlist, current, desired_keys):
+    # Movies on the longest run that is already in the wanted order stay in place,
+    # every other movie is moved directly behind its wanted predecessor.
+    position = {key: i for i, key in enumerate(desired_keys)}
+    by_key = {}
+    sequence = []
+    for item in current:
+        if item.ratingKey in position and item.ratingKey not in by_key:
+            by_key[item.ratingKey] = item
+            sequence.append(position[item.ratingKey])
+
+    stable = {desired_keys[i] for i in __longest_increasing_subsequence__(sequence)}
+
+    moved = 0
+    previous = None
+    for key in desired_keys:
+        item = by_key.get(key)
+        if item is None:
+            continue
+        if key not in stable:
+            playlist.moveItem(item, after=previous)
+            moved += 1
+        previous = item
+    return moved
+
+
+def __longest_increasing_subsequence__(values):
+    tails = []  # tails[length - 1] = index of the smallest tail of an increasing run with that length
+    parents = [None] * len(values)
+
+    for i, value in enumerate(values):
+        low, high = 0, len(tails)
+        while low < high:
+            middle = (low + high) // 2
+            if values[tails[middle]] < value:
+                low = middle + 1
+            else:
+                high = middle
+        parents[i] = tails[low - 1] if low > 0 else None
+        if low == len(tails):
+            tails.append(i)
+        else:
+            tails[low] = i
+
+    result = []
+    index = tails[-1] if tails else None
+    while index is not None:
+        result.append(values[index])
+        index = parents[index]
+    return result
+
+
 def __read_watchlist_csv__(file_path):
     data = []
 